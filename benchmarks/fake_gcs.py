@@ -0,0 +1,229 @@
+"""
+
+In-memory stand-in of GCSHook and the google-cloud-storage objects used by
+the operators
+
+Objects up to MAX_KEPT_BYTES are kept (checkpoints, manifests, small
+outputs), larger ones only keep their size, hash and record count so the
+memory of the benchmark process reflects the operator and not the sink.
+Records are counted when an object is stored: lines of (gzip) newline
+delimited json, rows of parquet.
+
+"""
+
+import base64
+import hashlib
+import io
+import threading
+import zlib
+
+MAX_KEPT_BYTES = 1024 * 1024
+
+PARQUET_MIME_TYPE = "application/vnd.apache.parquet"
+
+# compressed bytes decompressed at a time when counting records
+COUNT_CHUNK_SIZE = 1024 * 1024
+
+
+def count_records(data, content_type=None, content_encoding=None):
+    """Returns the records of an object, lines of newline delimited json or parquet rows."""
+
+    if not data:
+        return 0
+
+    if content_type == PARQUET_MIME_TYPE:
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(io.BytesIO(data)).metadata.num_rows
+
+    if content_encoding == "gzip":
+        # decompress chunk by chunk, concatenated (composed) gzip members included
+        lines, last = 0, b"\n"
+        while data:
+            decompressor = zlib.decompressobj(31)
+            offset = 0
+            while offset < len(data) and not decompressor.eof:
+                chunk = decompressor.decompress(data[offset:offset + COUNT_CHUNK_SIZE])
+                offset += COUNT_CHUNK_SIZE
+                lines += chunk.count(b"\n")
+                last = chunk[-1:] or last
+            data = decompressor.unused_data + data[offset:]
+        return lines + (last != b"\n")
+
+    return data.count(b"\n") + (not data.endswith(b"\n"))
+
+
+class FakeStorage(object):
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.uploaded_bytes = 0
+        self.uploads = 0
+
+    def put(self, bucket_name, object_name, data, content_type=None, content_encoding=None, metadata=None, records=None):
+        if records is None:
+            records = count_records(data, content_type, content_encoding)
+        with self.lock:
+            self.uploads += 1
+            self.uploaded_bytes += len(data)
+            self.objects[(bucket_name, object_name)] = {
+                "data": bytes(data) if len(data) <= MAX_KEPT_BYTES else None,
+                "size": len(data),
+                "records": records,
+                "md5_hash": base64.b64encode(hashlib.md5(data).digest()).decode("ascii"),
+                "content_type": content_type,
+                "content_encoding": content_encoding,
+                "metadata": metadata,
+            }
+
+    def get(self, bucket_name, object_name):
+        with self.lock:
+            return self.objects.get((bucket_name, object_name))
+
+    def delete(self, bucket_name, object_name):
+        with self.lock:
+            self.objects.pop((bucket_name, object_name), None)
+
+    def names(self, bucket_name, prefix=None):
+        with self.lock:
+            return sorted(name for bucket, name in self.objects if bucket == bucket_name and name.startswith(prefix or ""))
+
+    def total_size(self):
+        with self.lock:
+            return sum(stored["size"] for stored in self.objects.values())
+
+    def total_records(self, bucket_name):
+        with self.lock:
+            return sum(stored["records"] for (bucket, _), stored in self.objects.items() if bucket == bucket_name)
+
+
+class _BlobWriter(io.RawIOBase):
+
+    def __init__(self, blob, content_type):
+        super(_BlobWriter, self).__init__()
+        self.blob = blob
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self._buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        return len(b)
+
+    def close(self):
+        if not self.closed and not self._buffer.closed:
+            self.blob._store(bytes(self.buffer), self.content_type)
+            self._buffer.close()
+        super(_BlobWriter, self).close()
+
+    def terminate(self):
+        # like google.cloud.storage.fileio.BlobWriter, discards the upload
+        self._buffer.close()
+        super(_BlobWriter, self).close()
+
+
+class FakeBlob(object):
+
+    def __init__(self, storage, bucket_name, name):
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.name = name
+        self.content_type = None
+        self.content_encoding = None
+        self.metadata = None
+
+        stored = storage.get(bucket_name, name)
+        self.md5_hash = stored["md5_hash"] if stored else None
+        if stored:
+            self.metadata = stored["metadata"]
+
+    def open(self, mode="rb", chunk_size=None, content_type=None, **kwargs):
+        if mode == "wb":
+            return _BlobWriter(self, content_type)
+        return io.BytesIO(self._data())
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        with open(filename, "rb") as f:
+            self._store(f.read(), content_type)
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        self._store(data.encode("utf-8") if isinstance(data, str) else data, content_type)
+
+    def compose(self, sources, **kwargs):
+        data = b"".join(source._data(allow_missing_data=True) for source in sources)
+        # the data of large sources is not kept, sum their counted records
+        records = sum(self.storage.get(source.bucket_name, source.name)["records"] for source in sources)
+        self._store(data, self.content_type, records)
+
+    def delete(self, **kwargs):
+        self.storage.delete(self.bucket_name, self.name)
+
+    def _store(self, data, content_type, records=None):
+        self.storage.put(self.bucket_name, self.name, data, content_type or self.content_type, self.content_encoding, self.metadata,
+            records)
+
+    def _data(self, allow_missing_data=False):
+        stored = self.storage.get(self.bucket_name, self.name)
+        if stored is None:
+            raise FileNotFoundError(f"gs://{self.bucket_name}/{self.name}")
+        if stored["data"] is None:
+            if allow_missing_data:
+                # large objects are not kept, compose their size only
+                return bytes(stored["size"])
+            raise ValueError(f"gs://{self.bucket_name}/{self.name} is too large to be kept by the fake storage")
+        return stored["data"]
+
+
+class FakeBucket(object):
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self.storage, self.name, name)
+
+    def get_blob(self, name):
+        return self.blob(name) if self.storage.get(self.name, name) else None
+
+
+class FakeClient(object):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def bucket(self, name):
+        return FakeBucket(self.storage, name)
+
+
+class FakeGCSHook(object):
+    """Replaces GCSHook in the operator modules, all instances share one FakeStorage."""
+
+    storage = FakeStorage()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_conn(self):
+        return FakeClient(self.storage)
+
+    def upload(self, bucket_name, object_name, filename=None, data=None, mime_type="application/octet-stream", **kwargs):
+        if filename is not None:
+            with open(filename, "rb") as f:
+                data = f.read()
+        self.storage.put(bucket_name, object_name, data.encode("utf-8") if isinstance(data, str) else data, mime_type)
+
+    def download(self, bucket_name, object_name, **kwargs):
+        return FakeBlob(self.storage, bucket_name, object_name)._data()
+
+    def exists(self, bucket_name, object_name, **kwargs):
+        return self.storage.get(bucket_name, object_name) is not None
+
+    def delete(self, bucket_name, object_name, **kwargs):
+        self.storage.delete(bucket_name, object_name)
+
+    def list(self, bucket_name, prefix=None, **kwargs):
+        return self.storage.names(bucket_name, prefix)
@@ -0,0 +1,344 @@
+"""
+
+Local stand-ins of the Iterable, Lytics and Google Search Console APIs
+
+One threaded HTTP server answers the endpoints used by the operators with
+generated data. Latency, the share of 429 responses and the payload sizes
+are configured through MockConfig. The server runs in its own process, so
+it does not compete with the benchmarked operator for the GIL, and counts
+the requests it answered and the records pushed to it (see
+MockServer.stats).
+
+"""
+
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+EXPORT_DATE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@dataclass
+class MockConfig:
+    latency: float = 0.0 # seconds before every response
+    rate_429: float = 0.0 # share of requests answered with 429 Too Many Requests
+    retry_after: float = 0.0 # Retry-After of the 429 responses
+    seed: int = 0
+
+    # Iterable /api/export/data.json: records spread evenly over [export_start, export_end)
+    export_records: int = 100000
+    export_start: str = "2024-01-01 00:00:00"
+    export_end: str = "2024-01-02 00:00:00"
+    record_padding: int = 200 # bytes of filler per exported record
+    export_chunk_records: int = 1000 # records per chunk of the streamed response
+
+    # Iterable templates and catalogs
+    templates_per_type: int = 50
+    template_size: int = 20000
+    catalogs: int = 4
+    catalog_items: int = 5000 # per catalog
+
+    # Lytics
+    jobs: int = 100
+    job_log_entries: int = 50 # per job
+    models: int = 20
+
+    # Google Search Console searchanalytics rows per query type
+    gsc_rows: int = 100000
+
+
+def _timestamp(value):
+    return datetime.strptime(value, EXPORT_DATE_TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    # set on the class created per server
+    config = None
+    counters = None
+    counters_lock = None
+    random = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self._read_body()
+
+        if url.path == "/__stats":
+            with self.counters_lock:
+                return self._send_json(dict(self.counters))
+
+        for pattern, route_method, handler in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if match and route_method == method:
+                break
+        else:
+            return self._send_json({"msg": f"Unknown endpoint {method} {url.path}"}, status=404)
+
+        with self.counters_lock:
+            self.counters["requests"] += 1
+            endpoint_key = f"{method} {pattern}"
+            self.counters[endpoint_key] = self.counters.get(endpoint_key, 0) + 1
+            throttled = self.random.random() < self.config.rate_429
+            if throttled:
+                self.counters["429"] += 1
+
+        if self.config.latency:
+            time.sleep(self.config.latency)
+
+        if throttled:
+            return self._send_json({"msg": "Too Many Requests"}, status=429,
+                headers={"Retry-After": f"{self.config.retry_after:g}"})
+
+        handler(self, query, body, *match.groups())
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else b""
+        if not data:
+            return {}
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(data)
+        return {key: values[-1] for key, values in parse_qs(data.decode("utf-8")).items()}
+
+    def _send_json(self, payload, status=200, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunked(self, chunks, content_type="application/x-json-stream"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            if chunk:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    # Iterable
+
+    def export_data_json(self, query, body):
+        config = self.config
+        start, end = _timestamp(config.export_start), _timestamp(config.export_end)
+        window_start = _timestamp(query["startDateTime"]) if "startDateTime" in query else start
+        window_end = _timestamp(query["endDateTime"]) if "endDateTime" in query else end
+
+        # record i is created at start + i * step
+        step = (end - start) / max(config.export_records, 1)
+        first = max(0, int(-(-(window_start - start) // step)))
+        last = min(config.export_records, int(-(-(window_end - start) // step)))
+
+        data_type_name = query.get("dataTypeName", "user")
+        padding = "x" * config.record_padding
+
+        def chunks():
+            for chunk_start in range(first, last, config.export_chunk_records):
+                lines = []
+                for i in range(chunk_start, min(chunk_start + config.export_chunk_records, last)):
+                    created_at = datetime.fromtimestamp(start + i * step, tz=timezone.utc).strftime(EXPORT_DATE_TIME_FORMAT)
+                    if data_type_name == "purchase":
+                        record = {"id": str(i), "email": f"user{i}@example.com", "createdAt": created_at, "total": i % 500 / 10,
+                            "shoppingCartItems": [{"id": str(i % 97), "price": 9.9, "quantity": 1, "name": padding}]}
+                    else:
+                        record = {"email": f"user{i}@example.com", "userId": str(i), "profileUpdatedAt": created_at,
+                            "signupDate": created_at, "locale": "de-CH", "notes": padding}
+                    lines.append(json.dumps(record))
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+
+        self._send_chunked(chunks())
+
+    def campaigns(self, query, body):
+        self._send_json({"campaigns": [{"id": i, "name": f"campaign {i}", "type": "Blast"} for i in range(200)]})
+
+    def channels(self, query, body):
+        self._send_json({"channels": [{"id": i, "name": f"channel {i}", "channelType": "Marketing"} for i in range(10)]})
+
+    def message_types(self, query, body):
+        self._send_json({"messageTypes": [{"id": i, "name": f"message type {i}", "channelId": i % 10} for i in range(50)]})
+
+    def templates(self, query, body):
+        type_offset = ["Base", "Blast", "Triggered", "Workflow"].index(query.get("templateType", "Base"))
+        now = int(time.time() * 1000)
+        self._send_json({"templates": [
+            {"templateId": type_offset * 100000 + i, "name": f"template {i}", "createdAt": now - 86400000, "updatedAt": now - 3600000}
+            for i in range(self.config.templates_per_type)
+        ]})
+
+    def email_template(self, query, body):
+        self._send_json({"templateId": int(query["templateId"]), "name": "template", "subject": "subject",
+            "html": "<p>" + "x" * self.config.template_size + "</p>"})
+
+    def catalogs(self, query, body):
+        page, page_size = int(query.get("page", 1)), int(query.get("pageSize", 10000))
+        names = [{"name": f"catalog{i}"} for i in range(self.config.catalogs)]
+        self._send_json({"params": self._page(names, "catalogNames", page, page_size)})
+
+    def catalog_items(self, query, body, catalog_name):
+        page, page_size = int(query.get("page", 1)), int(query.get("pageSize", 10000))
+        items = range(self.config.catalog_items)
+        page_items = [
+            {"catalogName": catalog_name, "itemId": str(i), "size": 100, "lastModified": 1700000000000,
+                "value": {"name": f"item {i}", "price": i % 100, "tags": ["a", "b"]}}
+            for i in items[(page - 1) * page_size:page * page_size]
+        ]
+        params = {"catalogItemsWithProperties": page_items, "totalCount": len(items)}
+        if page * page_size < len(items):
+            params["nextPageUrl"] = f"/api/catalogs/{catalog_name}/items?page={page + 1}&pageSize={page_size}"
+        self._send_json({"params": params})
+
+    def bulk_update_users(self, query, body):
+        self._count_received(len(body.get("users", [])))
+        self._send_json({"successCount": len(body.get("users", [])), "failCount": 0, "invalidEmails": [], "invalidUserIds": []})
+
+    def users_delete(self, query, body, email):
+        self._send_json({"msg": "User deleted", "code": "Success"})
+
+    def bulk_subscription_action(self, query, body, group, group_id):
+        self._send_json({"successCount": len(body.get("users", body.get("usersIds", []))), "failCount": 0})
+
+    # Lytics
+
+    def lytics_jobs(self, query, body):
+        self._send_json({"data": [{"id": f"job{i}", "status": "running", "workflow": "export"} for i in range(self.config.jobs)]})
+
+    def lytics_job_logs(self, query, body, job_id):
+        self._send_json({"data": [
+            {"job_id": job_id, "id": f"{job_id}-{i}", "ts": 1700000000000 + i * 1000, "level": "info", "msg": f"log line {i}"}
+            for i in range(self.config.job_log_entries)
+        ]})
+
+    def lytics_models(self, query, body):
+        self._send_json({"data": [{"id": f"model{i}", "name": f"model {i}"} for i in range(self.config.models)]})
+
+    def lytics_model_summary(self, query, body, model_id):
+        self._send_json({"data": {"id": model_id, "accuracy": 0.9, "features": [{"name": f"f{i}", "importance": i} for i in range(50)]}})
+
+    # Google Search Console
+
+    def gsc_query(self, query, body, site_url):
+        start_row, row_limit = int(body.get("startRow", 0)), int(body.get("rowLimit", 25000))
+        rows = [
+            {"keys": [f"query {i}", f"https://example.com/{i % 1000}"], "clicks": i % 10, "impressions": i % 100,
+                "ctr": 0.1, "position": 3.5}
+            for i in range(start_row, min(start_row + row_limit, self.config.gsc_rows))
+        ]
+        self._send_json({"rows": rows} if rows else {})
+
+    def _count_received(self, records):
+        with self.counters_lock:
+            self.counters["received_records"] += records
+
+    @staticmethod
+    def _page(items, key, page, page_size):
+        params = {key: items[(page - 1) * page_size:page * page_size]}
+        if page * page_size < len(items):
+            params["nextPageUrl"] = f"?page={page + 1}&pageSize={page_size}"
+        return params
+
+
+ROUTES = [
+    (r"/api/export/data\.json", "GET", _Handler.export_data_json),
+    (r"/api/campaigns", "GET", _Handler.campaigns),
+    (r"/api/channels", "GET", _Handler.channels),
+    (r"/api/messageTypes", "GET", _Handler.message_types),
+    (r"/api/templates", "GET", _Handler.templates),
+    (r"/api/templates/email/get", "GET", _Handler.email_template),
+    (r"/api/catalogs", "GET", _Handler.catalogs),
+    (r"/api/catalogs/([^/]+)/items", "GET", _Handler.catalog_items),
+    (r"/api/users/bulkUpdate", "POST", _Handler.bulk_update_users),
+    (r"/api/users/([^/]+)", "DELETE", _Handler.users_delete),
+    (r"/api/subscriptions/([^/]+)/([^/]+)", "PUT", _Handler.bulk_subscription_action),
+    (r"/v2/job", "GET", _Handler.lytics_jobs),
+    (r"/v2/job/([^/]+)/logs", "GET", _Handler.lytics_job_logs),
+    (r"/api/ml", "GET", _Handler.lytics_models),
+    (r"/api/ml/([^/]+)/summary", "GET", _Handler.lytics_model_summary),
+    (r"/webmasters/v3/sites/([^/]+)/searchAnalytics/query", "POST", _Handler.gsc_query),
+]
+
+
+def _serve(config, port_queue):
+    handler = type("Handler", (_Handler,), {
+        "config": config,
+        "counters": {"requests": 0, "429": 0, "received_records": 0},
+        "counters_lock": threading.Lock(),
+        "random": random.Random(config.seed),
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class MockServer(object):
+    """Runs the mock APIs in a child process, use as context manager."""
+
+    def __init__(self, config=None):
+        self.config = config or MockConfig()
+        self.url = None
+        self._process = None
+
+    def __enter__(self):
+        context = multiprocessing.get_context("spawn")
+        port_queue = context.Queue()
+        self._process = context.Process(target=_serve, args=(self.config, port_queue), daemon=True)
+        self._process.start()
+        self.url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+        return self
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.join()
+
+    def stats(self):
+        """Returns the counters (requests in total, 429 and per endpoint, received_records)."""
+
+        with urlopen(f"{self.url}/__stats") as response:
+            return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serves the mock APIs until interrupted")
+    for name, value in asdict(MockConfig()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+
+    with MockServer(MockConfig(**vars(args))) as mock_server:
+        print(f"Serving mock APIs on {mock_server.url}", flush=True)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
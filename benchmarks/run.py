@@ -0,0 +1,206 @@
+"""
+
+Offline benchmark of the operators
+
+Runs every scenario (see benchmarks/scenarios.py) in its own process
+against the local mock APIs and the fake GCS storage and reports records
+per second, peak RSS, request count and wall time. Throughput is based on
+the records the operator actually wrote, a scenario writing more or fewer
+records than expected fails.
+
+    python benchmarks/run.py                              # all scenarios
+    python benchmarks/run.py iterable_user_export --repeat 3
+    python benchmarks/run.py --latency 0.1 --rate-429 0.05
+    python benchmarks/run.py --save-baseline benchmarks/baselines/main.json
+    python benchmarks/run.py --compare benchmarks/baselines/main.json --max-regression 0.1
+
+Requires the Airflow environment of the plugins (apache-airflow with the
+http and google providers).
+
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGINS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "plugins")
+
+
+class FakeTaskInstance(object):
+
+    dag_id = "benchmark"
+    task_id = "benchmark"
+    run_id = "benchmark"
+    map_index = -1
+
+    def __init__(self):
+        self.xcom = {}
+
+    def xcom_push(self, key, value, **kwargs):
+        self.xcom[key] = value
+
+
+def _peak_rss_bytes():
+    # of the operator process only, the mock server runs in a child process
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_scenario(name, mock_overrides):
+    """Runs one scenario in the current process and returns its measurements."""
+
+    sys.path.insert(0, PLUGINS_DIR)
+    sys.path.insert(0, BENCHMARKS_DIR)
+
+    from fake_gcs import FakeGCSHook
+    from mock_servers import MockConfig, MockServer
+    from scenarios import ITERABLE_CONN_ID, LYTICS_CONN_ID, SCENARIOS_BY_NAME, MockGscHook
+
+    scenario = SCENARIOS_BY_NAME[name]
+    config = MockConfig(**dict(scenario.mock_config, **mock_overrides))
+
+    with MockServer(config) as mock_server:
+        for conn_id in (ITERABLE_CONN_ID, LYTICS_CONN_ID):
+            os.environ[f"AIRFLOW_CONN_{conn_id.upper()}"] = json.dumps(
+                {"conn_type": "http", "host": mock_server.url, "password": "benchmark"})
+        MockGscHook.url = mock_server.url
+
+        from operators import gsc_operator, iterable_api_to_gcs_operator, iterable_bulk_operator, lytics_api_to_gcs_operator
+        for module in (gsc_operator, iterable_api_to_gcs_operator, iterable_bulk_operator, lytics_api_to_gcs_operator):
+            module.GCSHook = FakeGCSHook
+        gsc_operator.GscHook = MockGscHook
+
+        operator = scenario.build_operator(config)
+        task_instance = FakeTaskInstance()
+
+        started = time.perf_counter()
+        operator.execute({"ti": task_instance})
+        wall_time = time.perf_counter() - started
+
+        stats = mock_server.stats()
+
+    records = scenario.count_records(FakeGCSHook.storage, stats)
+    expected_records = scenario.expected_records(config)
+    if records != expected_records:
+        return {"scenario": name, "error": f"wrote {records} records, expected {expected_records}"}
+
+    return {
+        "scenario": name,
+        "records": records,
+        "wall_time_seconds": round(wall_time, 3),
+        "records_per_second": round(records / wall_time, 1) if wall_time else None,
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "requests": stats["requests"],
+        "throttled_requests": stats["429"],
+        "uploaded_bytes": FakeGCSHook.storage.uploaded_bytes,
+        "stored_bytes": FakeGCSHook.storage.total_size(),
+        "mock_config": asdict(config),
+    }
+
+
+def _run_child(name, mock_overrides):
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", name, "--mock-config", json.dumps(mock_overrides)],
+        stdout=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        return {"scenario": name, "error": f"exit code {process.returncode}"}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def _best(results):
+    # the fastest run is the least disturbed by the machine
+    ok = [result for result in results if "error" not in result]
+    return min(ok, key=lambda result: result["wall_time_seconds"]) if ok else results[-1]
+
+
+def _format_table(results, baseline):
+    header = f"{'scenario':<48} {'records/s':>12} {'wall s':>9} {'peak RSS MiB':>13} {'requests':>9} {'429':>6}"
+    lines = [header, "-" * len(header)]
+    for result in results:
+        if "error" in result:
+            lines.append(f"{result['scenario']:<48} {result['error']}")
+            continue
+
+        line = (f"{result['scenario']:<48} {result['records_per_second']:>12,.0f} {result['wall_time_seconds']:>9.2f} "
+            f"{result['peak_rss_bytes'] / 2 ** 20:>13.1f} {result['requests']:>9} {result['throttled_requests']:>6}")
+        base = baseline.get(result["scenario"])
+        if base and "error" not in base:
+            change = result["wall_time_seconds"] / base["wall_time_seconds"] - 1
+            line += f"   wall time {change:+.1%} vs baseline"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from scenarios import SCENARIOS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run (default all)")
+    parser.add_argument("--list", action="store_true", help="list the scenarios")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario, the fastest is reported")
+    parser.add_argument("--records", type=int, help="records of the Iterable export (MockConfig.export_records)")
+    parser.add_argument("--latency", type=float, help="mock API latency in seconds")
+    parser.add_argument("--rate-429", type=float, help="share of mock API requests answered with 429")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write the results as baseline json")
+    parser.add_argument("--compare", metavar="PATH", help="compare the wall times with a baseline json")
+    parser.add_argument("--max-regression", type=float,
+        help="exit with 1 when a wall time exceeds the baseline by more than this share (e.g. 0.1)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--mock-config", default="{}", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, json.loads(args.mock_config))))
+        return 0
+
+    if args.list:
+        for scenario in SCENARIOS:
+            print(scenario.name)
+        return 0
+
+    names = args.scenarios or [scenario.name for scenario in SCENARIOS]
+    mock_overrides = {key: value for key, value in (
+        ("export_records", args.records), ("latency", args.latency), ("rate_429", args.rate_429)) if value is not None}
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+
+    results = []
+    for name in names:
+        results.append(_best([_run_child(name, mock_overrides) for _ in range(args.repeat)]))
+        print(_format_table(results[-1:], baseline).splitlines()[-1], flush=True)
+
+    print()
+    print(_format_table(results, baseline))
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump({"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                "results": results}, f, indent=2)
+
+    if args.max_regression is not None and baseline:
+        regressions = [
+            result["scenario"] for result in results
+            if "error" not in result and result["scenario"] in baseline and "error" not in baseline[result["scenario"]]
+            and result["wall_time_seconds"] > baseline[result["scenario"]]["wall_time_seconds"] * (1 + args.max_regression)
+        ]
+        if regressions:
+            print(f"\nRegressions beyond {args.max_regression:.0%}: {', '.join(regressions)}")
+            return 1
+
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
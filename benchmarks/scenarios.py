@@ -0,0 +1,186 @@
+"""
+
+Benchmark scenarios: one operator configuration each, run against the mock
+APIs and the fake GCS storage
+
+Every scenario returns the operator to execute, the mock API configuration
+(overrides of MockConfig), the number of records the operator is expected
+to write and how the records it actually wrote are counted (by default
+the records stored in the fake GCS bucket).
+
+"""
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict
+
+import requests
+
+ITERABLE_CONN_ID = "iterable_bench"
+LYTICS_CONN_ID = "lytics_bench"
+BUCKET = "bench-bucket"
+
+
+def _stored_records(storage, mock_stats):
+    # every scenario runs in a new process, the bucket only holds its output
+    return storage.total_records(BUCKET)
+
+
+def _received_records(storage, mock_stats):
+    return mock_stats["received_records"]
+
+
+@dataclass
+class Scenario:
+    name: str
+    build_operator: Callable # (mock_config) -> operator
+    expected_records: Callable # (mock_config) -> int
+    mock_config: Dict = field(default_factory=dict)
+    count_records: Callable = _stored_records # (fake storage, mock stats) -> records written by the operator
+
+
+class MockGscHook(object):
+    """Replaces GscHook, sends the searchanalytics queries to the mock API."""
+
+    url = None
+
+    def __init__(self, *args, **kwargs):
+        self.session = requests.Session()
+
+    def get_data(self, site_url, start_date, end_date, dimensions, aggregation_type, type, data_state, start_row, row_limit):
+        response = self.session.post(
+            f"{self.url}/webmasters/v3/sites/{requests.utils.quote(site_url, safe='')}/searchAnalytics/query",
+            json={
+                "startDate": start_date,
+                "endDate": end_date,
+                "dimensions": dimensions,
+                "aggregationType": aggregation_type,
+                "type": type,
+                "dataState": data_state,
+                "startRow": start_row,
+                "rowLimit": row_limit
+            }
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+def _export(operator_class_name, **kwargs):
+    def build(config):
+        from operators import iterable_api_to_gcs_operator
+
+        operator_class = getattr(iterable_api_to_gcs_operator, operator_class_name)
+        if operator_class_name == "IterableUserAPIToGoogleCloudStorage":
+            kwargs.setdefault("fields", ["email", "userId", "profileUpdatedAt", "signupDate", "locale", "notes"])
+        return operator_class(
+            task_id="benchmark",
+            gcs_bucket=BUCKET,
+            gcs_filepath=f"export/{operator_class_name}.json",
+            start_date_time=config.export_start,
+            end_date_time=config.export_end,
+            itr_conn_id=ITERABLE_CONN_ID,
+            **kwargs)
+    return build
+
+
+def _iterable(operator_class_name, **kwargs):
+    def build(config):
+        from operators import iterable_api_to_gcs_operator
+
+        operator_class = getattr(iterable_api_to_gcs_operator, operator_class_name)
+        return operator_class(
+            task_id="benchmark",
+            gcs_bucket=BUCKET,
+            gcs_filepath=f"iterable/{operator_class_name}.json",
+            itr_conn_id=ITERABLE_CONN_ID,
+            **kwargs)
+    return build
+
+
+def _email_templates(**kwargs):
+    def build(config):
+        now = datetime.now(timezone.utc)
+        return _iterable(
+            "IterableEmailTemplateAPIToGoogleCloudStorage",
+            updated_at_start_date=(now - timedelta(days=1)).isoformat(),
+            updated_at_end_date=(now + timedelta(days=1)).isoformat(),
+            **kwargs)(config)
+    return build
+
+
+def _bulk_update_users(**kwargs):
+    def build(config):
+        from operators.iterable_bulk_operator import IterableBulkUpdateUsersOperator
+
+        users = [{"email": f"user{i}@example.com", "dataFields": {"score": i}} for i in range(config.export_records)]
+        return IterableBulkUpdateUsersOperator(task_id="benchmark", users=users, itr_conn_id=ITERABLE_CONN_ID, **kwargs)
+    return build
+
+
+def _lytics(lytics_api_path, **kwargs):
+    def build(config):
+        from operators.lytics_api_to_gcs_operator import LyticsAPIToGoogleCloudStorage
+
+        return LyticsAPIToGoogleCloudStorage(
+            task_id="benchmark",
+            lytics_conn_id=LYTICS_CONN_ID,
+            lytics_api_path=lytics_api_path,
+            gcs_bucket=BUCKET,
+            gcs_filepath=f"lytics/{lytics_api_path.strip('/').replace('/', '_')}.json",
+            **kwargs)
+    return build
+
+
+def _gsc(**kwargs):
+    def build(config):
+        from operators.gsc_operator import GoogleSearchConsoleToGcsOperator
+
+        return GoogleSearchConsoleToGcsOperator(
+            task_id="benchmark",
+            site_url="sc-domain:example.com",
+            date="2024-01-01",
+            aggregation_type="byPage",
+            dimensions=["query", "page"],
+            types=["web"],
+            data_state="final",
+            gcs_bucket=BUCKET,
+            gcs_filepath="gsc/searchanalytics.json",
+            **kwargs)
+    return build
+
+
+def _export_records(config):
+    return config.export_records
+
+
+SCENARIOS = [
+    Scenario("iterable_user_export", _export("IterableUserAPIToGoogleCloudStorage"), _export_records),
+    Scenario("iterable_user_export_passthrough", _export("IterableUserAPIToGoogleCloudStorage", passthrough=True), _export_records),
+    Scenario("iterable_user_export_gzip", _export("IterableUserAPIToGoogleCloudStorage", compression="gzip"), _export_records),
+    Scenario("iterable_user_export_windows", _export("IterableUserAPIToGoogleCloudStorage", parallel_windows=4), _export_records,
+        {"latency": 0.2}),
+    Scenario("iterable_user_export_sharded", _export("IterableUserAPIToGoogleCloudStorage", max_shard_records=20000), _export_records),
+    Scenario("iterable_purchase_export", _export("IterablePurchaseAPIToGoogleCloudStorage"), _export_records),
+    Scenario("iterable_purchase_export_parallel_transform",
+        _export("IterablePurchaseAPIToGoogleCloudStorage", parallel_transform=True), _export_records),
+    Scenario("iterable_purchase_export_parquet",
+        _export("IterablePurchaseAPIToGoogleCloudStorage", output_format="parquet"), _export_records),
+    Scenario("iterable_email_templates", _email_templates(max_concurrency=8),
+        lambda config: 4 * config.templates_per_type, {"latency": 0.05}),
+    Scenario("iterable_catalog", _iterable("IterableCatalogAPIToGoogleCloudStorage", max_concurrency=4),
+        lambda config: config.catalogs * config.catalog_items, {"latency": 0.05}),
+    Scenario("iterable_campaigns", _iterable("IterableCampaignsAPIToGoogleCloudStorage", skip_unchanged=False), lambda config: 200),
+    Scenario("iterable_bulk_update_users", _bulk_update_users(max_concurrency=4), _export_records,
+        {"export_records": 20000, "latency": 0.05}, _received_records),
+    Scenario("lytics_jobs", _lytics("/v2/job"), lambda config: config.jobs),
+    Scenario("lytics_job_logs", _lytics("/v2/job/{id}/logs"), lambda config: config.jobs * config.job_log_entries,
+        {"latency": 0.05}),
+    Scenario("lytics_job_logs_concurrent", _lytics("/v2/job/{id}/logs", max_concurrency=8),
+        lambda config: config.jobs * config.job_log_entries, {"latency": 0.05}),
+    Scenario("lytics_ml_summary", _lytics("/api/ml/{id}/summary"), lambda config: config.models, {"latency": 0.05}),
+    Scenario("lytics_ml_summary_concurrent", _lytics("/api/ml/{id}/summary", max_concurrency=8), lambda config: config.models,
+        {"latency": 0.05}),
+    Scenario("gsc_search_analytics", _gsc(), lambda config: config.gsc_rows),
+]
+
+SCENARIOS_BY_NAME = {scenario.name: scenario for scenario in SCENARIOS}
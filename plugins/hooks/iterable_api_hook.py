@@ -5,31 +5,37 @@ Iterable API Hook
 
 """
 import logging
+from datetime import datetime
 from urllib.parse import quote_plus
 
 import tenacity
-from airflow.providers.http.hooks.http import HttpHook
 from airflow.exceptions import AirflowFailException
 
+from hooks import json_codec
+from hooks.pooled_http_hook import PooledHttpHook
+from hooks.rate_limiter import wait_rate_limited
 
-class IterableAPIHook(HttpHook):
+
+class IterableAPIHook(PooledHttpHook):
 
     # FIXME: add retries for http calls regarding connection error
 
+    export_date_time_format = "%Y-%m-%d %H:%M:%S"
+
     def __init__(self, 
             itr_conn_id='iterable_api_default'):
         super(IterableAPIHook, self).__init__(
-            http_conn_id=None
+            api_conn_id=itr_conn_id
         )
         self.log.setLevel(logging.WARNING)
 
-        itr_conn = self.get_connection(itr_conn_id)
+        itr_conn = self.api_conn
 
         self.itr_base_url = itr_conn.host
         self.itr_api_key = itr_conn.password
 
         self.retry_args = dict(
-            wait=tenacity.wait_random_exponential(max=60),
+            wait=wait_rate_limited(tenacity.wait_random_exponential(max=60)),
             stop=tenacity.stop_after_attempt(10)
         )
 
@@ -44,7 +50,7 @@ class IterableAPIHook(HttpHook):
         self.method = 'POST'
         response = self.run_with_advanced_retry(
             endpoint=f"{self.itr_base_url}/api/users/bulkUpdate",
-            json = bulk_update_users_request,
+            data = json_codec.dumps(bulk_update_users_request),
             headers = {
                 "Content-Type": "application/json",
                 "Api-Key": self.itr_api_key
@@ -103,7 +109,7 @@ class IterableAPIHook(HttpHook):
             params = {
                 "action": action
             },
-            json = bulk_subscription_action_request,
+            data = json_codec.dumps(bulk_subscription_action_request),
             headers = {
                 "Content-Type": "application/json",
                 "Api-Key": self.itr_api_key
@@ -311,4 +317,76 @@ class IterableAPIHook(HttpHook):
             _retry_args=self.retry_args
         )
         
-        return response
\ No newline at end of file
+        return response
+
+    @classmethod
+    def split_export_range(cls, start_date_time, end_date_time, windows):
+        """
+        Splits an export range into contiguous windows of (almost) equal size.
+
+        Iterable treats startDateTime as inclusive and endDateTime as
+        exclusive, so consecutive windows share their boundaries.
+
+        :param start_date_time: yyyy-MM-dd HH:mm:ss
+        :type start_date_time: string
+        :param end_date_time: yyyy-MM-dd HH:mm:ss
+        :type end_date_time: string
+        :param windows: number of windows
+        :type windows: int
+        :return: list of (start_date_time, end_date_time) tuples
+        """
+
+        start = datetime.strptime(start_date_time, cls.export_date_time_format)
+        end = datetime.strptime(end_date_time, cls.export_date_time_format)
+
+        # the API works with second precision, never create empty windows
+        windows = max(1, min(windows, int((end - start).total_seconds())))
+        step = (end - start) / windows
+
+        boundaries = [start + step * i for i in range(windows)] + [end]
+        boundaries = [boundary.replace(microsecond=0) for boundary in boundaries]
+
+        return [
+            (boundaries[i].strftime(cls.export_date_time_format), boundaries[i + 1].strftime(cls.export_date_time_format))
+            for i in range(windows)
+        ]
+
+    def iter_catalogs(self, page_size=10000, check_http_error=True):
+        """
+        Iterates over all pages of https://api.iterable.com/api/docs#catalogs_listCatalogs
+
+        :return: generator of catalog name lists, one per page
+        """
+
+        page = 1
+        while True:
+            data_r = self.catalogs(page=page, page_size=page_size, check_http_error=check_http_error)
+            params = json_codec.loads(data_r.content)["params"]
+
+            catalog_names = params.get("catalogNames") or []
+            if catalog_names:
+                yield catalog_names
+
+            if not catalog_names or not params.get("nextPageUrl"):
+                break
+            page += 1
+
+    def iter_catalog_items(self, catalog_name, page_size=10000, check_http_error=True):
+        """
+        Iterates over all pages of https://api.iterable.com/api/docs#catalogs_listCatalogItems
+
+        :return: generator of catalog item lists, one per page
+        """
+
+        page = 1
+        while True:
+            data_r = self.catalog_items(catalog_name, page=page, page_size=page_size, check_http_error=check_http_error)
+            params = json_codec.loads(data_r.content)["params"]
+
+            catalog_items = params.get("catalogItemsWithProperties") or []
+            if catalog_items:
+                yield catalog_items
+
+            if not catalog_items or not params.get("nextPageUrl"):
+                break
+            page += 1
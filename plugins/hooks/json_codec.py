@@ -0,0 +1,69 @@
+"""
+
+JSON (de)serialization of the hooks and operators
+
+Uses orjson when it is installed and falls back to the stdlib json module.
+Both backends write the same compact utf-8 json, except for float
+formatting and NaN/Infinity, which orjson writes as null. Input orjson
+rejects (NaN/Infinity literals, integers beyond 64 bit) is parsed and
+written by the stdlib json module, so it never fails with orjson only.
+
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "json" if orjson is None else "orjson"
+
+_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+def loads(data):
+    """Parses json from str or bytes (pass response.content to skip decoding the body)."""
+
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. NaN/Infinity or integers beyond 64 bit, which stdlib json accepts
+            pass
+    return json.loads(data)
+
+
+def dumps(obj):
+    """Serializes obj to compact json bytes."""
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. integers beyond 64 bit or non string keys, which stdlib json handles
+            pass
+    return _encoder.encode(obj).encode("utf-8")
+
+
+def dumps_str(obj):
+    """Serializes obj to a compact json string (e.g. for json typed fields)."""
+
+    return dumps(obj).decode("utf-8")
+
+
+def dump_line(obj):
+    """Serializes obj to one line of newline delimited json bytes."""
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            pass
+    return (_encoder.encode(obj) + "\n").encode("utf-8")
+
+
+def dump_lines(records):
+    """Serializes a batch of records to newline delimited json bytes."""
+
+    return b"".join([dump_line(record) for record in records])
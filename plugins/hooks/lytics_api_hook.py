@@ -9,24 +9,26 @@ import logging
 from urllib.parse import quote_plus
 
 import tenacity
-from airflow.providers.http.hooks.http import HttpHook
 
+from hooks.pooled_http_hook import PooledHttpHook
+from hooks.rate_limiter import wait_rate_limited
 
-class LyticsAPIHook(HttpHook):
+
+class LyticsAPIHook(PooledHttpHook):
 
     # FIXME: add retries for http calls regarding connection error
 
     def __init__(self, 
             lytics_conn_id='lytics_api_default'):
         super(LyticsAPIHook, self).__init__(
-            http_conn_id=None
+            api_conn_id=lytics_conn_id
         )
         self.log.setLevel(logging.WARNING)
 
-        self.lytics_conn = self.get_connection(lytics_conn_id)
+        self.lytics_conn = self.api_conn
 
         self.retry_args = dict(
-            wait=tenacity.wait_random_exponential(max=60),
+            wait=wait_rate_limited(tenacity.wait_random_exponential(max=60)),
             stop=tenacity.stop_after_attempt(10)
         )
 
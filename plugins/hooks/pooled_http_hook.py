@@ -0,0 +1,187 @@
+"""
+### Description
+
+Pooled HTTP Hook
+
+Base hook for the API hooks which keeps one process-wide, pooled keep-alive
+requests session per connection id, so that consecutive calls (and hook
+instances) reuse already established TCP/TLS connections.
+
+Pool and keep-alive settings are read from the connection extras:
+    - pool_connections: number of per-host pools to cache (default 10)
+    - pool_maxsize: number of connections kept open per host (default 10)
+    - tcp_keep_alive: enable TCP keep-alive probes (default true)
+    - tcp_keep_alive_idle: seconds before the first probe (default 120)
+    - tcp_keep_alive_count: failed probes before dropping (default 20)
+    - tcp_keep_alive_interval: seconds between probes (default 30)
+
+Every request also passes the shared client side rate limiter of its
+connection and endpoint family, see hooks.rate_limiter, and is recorded in
+the request metrics, see hooks.request_metrics.
+
+"""
+import os
+import threading
+import time
+
+import requests
+from airflow.providers.http.hooks.http import HttpHook
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.adapters.socket_options import TCPKeepAliveAdapter
+
+from hooks import request_metrics
+from hooks.rate_limiter import RateLimitExceeded, endpoint_family, get_token_bucket, retry_after_seconds
+
+
+def _extra_int(extra, key, default):
+    value = extra.get(key)
+    return default if value in (None, "") else int(value)
+
+
+def _extra_bool(extra, key, default):
+    value = extra.get(key)
+    if value in (None, ""):
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+class PooledHttpHook(HttpHook):
+
+    # sessions are shared by all hook instances of the current process
+    _sessions = {}
+    _sessions_pid = None
+    _sessions_lock = threading.Lock()
+
+    def __init__(self,
+            api_conn_id):
+        # keep-alive is handled by the pooled adapter, the default HttpHook
+        # behaviour would mount a new adapter (and pool) on every call
+        super(PooledHttpHook, self).__init__(
+            http_conn_id=None,
+            tcp_keep_alive=False
+        )
+        self.api_conn_id = api_conn_id
+        self.api_conn = self.get_connection(api_conn_id)
+        self.api_conn_extra = self.api_conn.extra_dejson
+
+    def get_conn(self, headers=None):
+        """
+        Returns the pooled session of the connection.
+
+        Headers are passed with every request by HttpHook.run, therefore the
+        shared session itself is never modified here.
+        """
+
+        with PooledHttpHook._sessions_lock:
+            # never reuse sockets inherited from a parent process (e.g. forked task runners)
+            if PooledHttpHook._sessions_pid != os.getpid():
+                PooledHttpHook._sessions = {}
+                PooledHttpHook._sessions_pid = os.getpid()
+
+            session = PooledHttpHook._sessions.get(self.api_conn_id)
+            if session is None:
+                session = self._create_session()
+                PooledHttpHook._sessions[self.api_conn_id] = session
+
+        return session
+
+    def run_with_advanced_retry(self, _retry_args, *args, **kwargs):
+        """Runs the request with retries, recording every retry and its backoff."""
+
+        endpoint = kwargs.get("endpoint") or (args[0] if args else "")
+        family = endpoint_family(endpoint or "")
+        before_sleep = _retry_args.get("before_sleep")
+
+        def record_retry(retry_state):
+            backoff = retry_state.next_action.sleep if retry_state.next_action else 0.0
+            request_metrics.record_retry(self.api_conn_id, family, backoff)
+            if before_sleep is not None:
+                before_sleep(retry_state)
+
+        return super(PooledHttpHook, self).run_with_advanced_retry(
+            dict(_retry_args, before_sleep=record_retry), *args, **kwargs)
+
+    def run_and_check(self, session, prepped_request, extra_options):
+        """
+        Sends the request once the rate limiter allows it.
+
+        429 responses pause the token bucket of the endpoint family (for all
+        hook instances of the process). With check_response (the default)
+        they raise RateLimitExceeded, so that the request gets retried,
+        otherwise the response is returned like any other.
+        """
+
+        extra_options = extra_options or {}
+
+        family = endpoint_family(prepped_request.url)
+        token_bucket = get_token_bucket(self.api_conn_id, family, self.api_conn_extra)
+        throttled = token_bucket.acquire()
+
+        started = time.monotonic()
+        try:
+            response = super(PooledHttpHook, self).run_and_check(
+                session, prepped_request, dict(extra_options, check_response=False))
+        except Exception:
+            request_metrics.record_request(self.api_conn_id, family, None, time.monotonic() - started, throttled, 0)
+            raise
+        latency = time.monotonic() - started
+        token_bucket.update(response)
+
+        if extra_options.get("stream"):
+            # the body is only read by the caller, count it once the response is closed
+            request_metrics.record_request(self.api_conn_id, family, response.status_code, latency, throttled, 0)
+            self._record_bytes_on_close(response, family)
+        else:
+            request_metrics.record_request(
+                self.api_conn_id, family, response.status_code, latency, throttled, len(response.content))
+
+        if not extra_options.get("check_response", True):
+            return response
+
+        if response.status_code == 429:
+            self.log.warning("Rate limited on %s, retrying once the rate limiter allows it", prepped_request.url)
+            response.close()
+            raise RateLimitExceeded(f"429 Too Many Requests: {prepped_request.url}", response=response,
+                retry_after=retry_after_seconds(response.headers.get("Retry-After")))
+
+        self.check_response(response)
+
+        return response
+
+    def _record_bytes_on_close(self, response, family):
+        close = response.close
+        conn_id = self.api_conn_id
+
+        def close_and_record():
+            if response.raw is not None and not getattr(response, "_bytes_recorded", False):
+                response._bytes_recorded = True
+                request_metrics.record_bytes(conn_id, family, response.raw.tell())
+            close()
+
+        response.close = close_and_record
+
+    def _create_session(self):
+        extra = self.api_conn_extra
+
+        adapter_args = dict(
+            pool_connections=_extra_int(extra, "pool_connections", 10),
+            pool_maxsize=_extra_int(extra, "pool_maxsize", 10)
+        )
+
+        if _extra_bool(extra, "tcp_keep_alive", True):
+            adapter = TCPKeepAliveAdapter(
+                idle=_extra_int(extra, "tcp_keep_alive_idle", 120),
+                count=_extra_int(extra, "tcp_keep_alive_count", 20),
+                interval=_extra_int(extra, "tcp_keep_alive_interval", 30),
+                **adapter_args
+            )
+        else:
+            adapter = HTTPAdapter(**adapter_args)
+
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        return session
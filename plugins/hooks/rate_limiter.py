@@ -0,0 +1,223 @@
+"""
+### Description
+
+Client side rate limiting for the API hooks
+
+Token buckets are shared by all hook instances of a process and keyed by
+connection id and endpoint family (e.g. "users", "export", "job"). They are
+configured from the connection extras:
+    - rate_limit: requests per second for every endpoint family (default unlimited)
+    - rate_limit_burst: bucket size (default max(1, rate_limit))
+    - rate_limits: per family overrides, e.g. {"export": 0.06, "users": {"rate": 5, "burst": 5}}
+
+Buckets are paused when the API answers with 429 (honouring Retry-After) or
+reports an exhausted quota through the RateLimit headers. A 429 without a
+positive Retry-After is retried with the fallback (exponential) backoff of
+wait_rate_limited.
+
+"""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from tenacity.wait import wait_base
+
+
+class RateLimitExceeded(requests.exceptions.HTTPError):
+    """
+    Raised for 429 responses, the bucket is already paused for retry_after
+    seconds (the Retry-After of the response, None if missing) when raised.
+    """
+
+    def __init__(self, *args, retry_after=None, **kwargs):
+        super(RateLimitExceeded, self).__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = float(rate) if rate else None
+        self.burst = float(burst) if burst else max(1.0, self.rate or 1.0)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+
+        :return: seconds spent waiting
+        """
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return waited
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return waited
+                    wait = (1.0 - self.tokens) / self.rate
+
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        """Stops handing out tokens for the given number of seconds."""
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            if self.rate is not None:
+                self.tokens = 0.0
+
+    def update(self, response):
+        """
+        Adapts the bucket to the rate limit information of a response.
+
+        :return: seconds the bucket got paused for
+        """
+
+        pause = None
+        if response.status_code == 429:
+            pause = retry_after_seconds(response.headers.get("Retry-After"))
+            if pause is None and self.rate:
+                # no hint from the API, hold the other requests for one refill period
+                pause = 1.0 / self.rate
+        else:
+            remaining = _first_header(response.headers, "X-RateLimit-Remaining", "RateLimit-Remaining")
+            reset = _first_header(response.headers, "X-RateLimit-Reset", "RateLimit-Reset")
+            if remaining is not None and reset is not None and _to_float(remaining) == 0:
+                pause = _reset_seconds(reset)
+
+        if pause:
+            self.pause(pause)
+
+        return pause or 0.0
+
+
+class wait_rate_limited(wait_base):
+    """
+    Retry wait strategy which leaves the backoff of 429 responses with a
+    positive Retry-After to the (already paused) token bucket and uses the
+    fallback strategy for any other failure, including 429 responses
+    without Retry-After.
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def __call__(self, retry_state):
+        outcome = retry_state.outcome
+        if outcome is not None and outcome.failed:
+            exception = outcome.exception()
+            if isinstance(exception, RateLimitExceeded) and exception.retry_after:
+                return 0
+        return self.fallback(retry_state)
+
+
+_buckets = {}
+_buckets_pid = None
+_buckets_lock = threading.Lock()
+
+
+def get_token_bucket(conn_id, family, extra):
+    """
+    Returns the process wide token bucket of a connection and endpoint family.
+
+    :param conn_id: Airflow connection id
+    :type conn_id: string
+    :param family: endpoint family, see endpoint_family()
+    :type family: string
+    :param extra: connection extras holding the rate limit configuration
+    :type extra: dict
+    """
+
+    global _buckets, _buckets_pid
+
+    with _buckets_lock:
+        if _buckets_pid != os.getpid():
+            _buckets = {}
+            _buckets_pid = os.getpid()
+
+        bucket = _buckets.get((conn_id, family))
+        if bucket is None:
+            rate = extra.get("rate_limit")
+            burst = extra.get("rate_limit_burst")
+            family_limit = (extra.get("rate_limits") or {}).get(family)
+            if isinstance(family_limit, dict):
+                rate = family_limit.get("rate", rate)
+                burst = family_limit.get("burst")
+            elif family_limit is not None:
+                rate, burst = family_limit, None
+
+            bucket = TokenBucket(rate=rate, burst=burst)
+            _buckets[(conn_id, family)] = bucket
+
+    return bucket
+
+
+def endpoint_family(url):
+    """
+    Derives the endpoint family from a request url, skipping api and version
+    prefixes, e.g. /api/users/bulkUpdate -> users, /v2/job/{id}/logs -> job.
+    """
+
+    for segment in urlparse(url).path.split("/"):
+        if not segment or segment == "api" or (segment[0] == "v" and segment[1:].isdigit()):
+            continue
+        return segment
+    return "default"
+
+
+def _first_header(headers, *names):
+    for name in names:
+        if name in headers:
+            return headers[name]
+    return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(value):
+    """Returns the seconds to wait of a Retry-After header (delta seconds or HTTP date), None if missing or invalid."""
+
+    if value is None:
+        return None
+
+    seconds = _to_float(value)
+    if seconds is not None:
+        return max(seconds, 0.0)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def _reset_seconds(value):
+    seconds = _to_float(value)
+    if seconds is None:
+        return None
+
+    # some APIs send an epoch timestamp instead of a delta
+    if seconds > 1e9:
+        seconds -= time.time()
+    return max(seconds, 0.0)
@@ -0,0 +1,180 @@
+"""
+### Description
+
+Request metrics of the API hooks
+
+PooledHttpHook records every request (status code, latency, time spent
+waiting for the rate limiter, bytes received) and every retry (with the
+backoff before it) per connection id and endpoint family. The measurements
+are sent to Airflow's Stats (StatsD when configured) as
+    - http_hook.<conn_id>.<family>.requests / .status.<code> / .errors
+    - http_hook.<conn_id>.<family>.latency / .throttled / .backoff (timings)
+    - http_hook.<conn_id>.<family>.retries / .bytes
+and aggregated by the RequestMetrics collectors active in the process, see
+report_request_metrics for the per task summary.
+
+"""
+import functools
+import logging
+import threading
+from bisect import bisect_left
+from datetime import timedelta
+
+from airflow.stats import Stats
+
+log = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class RequestMetrics(object):
+    """Thread safe aggregate of the request metrics per endpoint family."""
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def record_request(self, family, status_code, latency, throttled, received_bytes):
+        with self._lock:
+            metrics = self._family(family)
+            metrics["requests"] += 1
+            status = str(status_code) if status_code is not None else "error"
+            metrics["status"][status] = metrics["status"].get(status, 0) + 1
+            metrics["latency_seconds"] += latency
+            metrics["max_latency_seconds"] = max(metrics["max_latency_seconds"], latency)
+            metrics["latency_histogram"][bisect_left(LATENCY_BUCKETS, latency)] += 1
+            metrics["throttled_seconds"] += throttled
+            metrics["bytes"] += received_bytes
+
+    def record_bytes(self, family, received_bytes):
+        with self._lock:
+            self._family(family)["bytes"] += received_bytes
+
+    def record_retry(self, family, backoff):
+        with self._lock:
+            metrics = self._family(family)
+            metrics["retries"] += 1
+            metrics["backoff_seconds"] += backoff
+
+    def summary(self):
+        """Returns the metrics per endpoint family as json serializable dict."""
+
+        bucket_names = [f"le_{bound:g}" for bound in LATENCY_BUCKETS] + ["le_inf"]
+        with self._lock:
+            return {
+                family: dict(
+                    metrics,
+                    status=dict(metrics["status"]),
+                    latency_seconds=round(metrics["latency_seconds"], 3),
+                    max_latency_seconds=round(metrics["max_latency_seconds"], 3),
+                    throttled_seconds=round(metrics["throttled_seconds"], 3),
+                    backoff_seconds=round(metrics["backoff_seconds"], 3),
+                    latency_histogram=dict(zip(bucket_names, metrics["latency_histogram"])),
+                )
+                for family, metrics in self._families.items()
+            }
+
+    def _family(self, family):
+        metrics = self._families.get(family)
+        if metrics is None:
+            metrics = self._families[family] = {
+                "requests": 0,
+                "status": {},
+                "latency_seconds": 0.0,
+                "max_latency_seconds": 0.0,
+                "latency_histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+                "throttled_seconds": 0.0,
+                "retries": 0,
+                "backoff_seconds": 0.0,
+                "bytes": 0,
+            }
+        return metrics
+
+
+_collectors = []
+_collectors_lock = threading.Lock()
+
+
+def _active_collectors():
+    with _collectors_lock:
+        return list(_collectors)
+
+
+def record_request(conn_id, family, status_code, latency, throttled, received_bytes):
+    prefix = f"http_hook.{conn_id}.{family}"
+    Stats.incr(f"{prefix}.requests")
+    Stats.incr(f"{prefix}.status.{status_code}" if status_code is not None else f"{prefix}.errors")
+    Stats.timing(f"{prefix}.latency", timedelta(seconds=latency))
+    if throttled:
+        Stats.timing(f"{prefix}.throttled", timedelta(seconds=throttled))
+    if received_bytes:
+        Stats.incr(f"{prefix}.bytes", count=received_bytes)
+
+    for collector in _active_collectors():
+        collector.record_request(family, status_code, latency, throttled, received_bytes)
+
+
+def record_bytes(conn_id, family, received_bytes):
+    if not received_bytes:
+        return
+
+    Stats.incr(f"http_hook.{conn_id}.{family}.bytes", count=received_bytes)
+    for collector in _active_collectors():
+        collector.record_bytes(family, received_bytes)
+
+
+def record_retry(conn_id, family, backoff):
+    prefix = f"http_hook.{conn_id}.{family}"
+    Stats.incr(f"{prefix}.retries")
+    Stats.timing(f"{prefix}.backoff", timedelta(seconds=backoff))
+
+    for collector in _active_collectors():
+        collector.record_retry(family, backoff)
+
+
+def format_summary(summary):
+    """Formats a RequestMetrics summary as one line."""
+
+    if not summary:
+        return "no HTTP requests"
+
+    families = []
+    for family, metrics in sorted(summary.items()):
+        status = ", ".join(f"{code}: {count}" for code, count in sorted(metrics["status"].items()))
+        average_latency = metrics["latency_seconds"] / metrics["requests"] if metrics["requests"] else 0.0
+        families.append(
+            f"{family}: {metrics['requests']} requests ({status}), "
+            f"latency avg {average_latency:.3f}s max {metrics['max_latency_seconds']:.3f}s, "
+            f"{metrics['retries']} retries, {metrics['backoff_seconds']:.1f}s backoff, "
+            f"{metrics['throttled_seconds']:.1f}s throttled, {metrics['bytes']} bytes"
+        )
+    return "; ".join(families)
+
+
+def report_request_metrics(execute):
+    """
+    Decorates an operator's execute method: the metrics of the requests sent
+    during execute are logged as one summary line and pushed to XCom (key
+    "request_metrics"), also when execute fails.
+    """
+
+    @functools.wraps(execute)
+    def wrapper(self, context, *args, **kwargs):
+        metrics = RequestMetrics()
+        with _collectors_lock:
+            _collectors.append(metrics)
+        try:
+            return execute(self, context, *args, **kwargs)
+        finally:
+            with _collectors_lock:
+                _collectors.remove(metrics)
+
+            summary = metrics.summary()
+            log.info("Request metrics: %s", format_summary(summary))
+            try:
+                context["ti"].xcom_push(key="request_metrics", value=summary)
+            except Exception:
+                log.exception("Could not push the request metrics to XCom")
+
+    return wrapper
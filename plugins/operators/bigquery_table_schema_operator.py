@@ -5,13 +5,14 @@ BigQuery Table Schema to Google Cloud Storage export operator
 """
 
 import logging
-import json
-from tempfile import NamedTemporaryFile
 
 from airflow.models import BaseOperator
 from airflow.providers.google.cloud.hooks.bigquery import BigQueryHook
 from airflow.providers.google.cloud.hooks.gcs import GCSHook
 
+from hooks import json_codec
+from operators.gcs_sink import open_gcs_sink
+
 
 log = logging.getLogger(__name__)
 
@@ -35,6 +36,9 @@ class BigQueryTableSchemaToGoogleCloudStorage(BaseOperator):
             destination_gcs_filepath=None,
             gcp_conn_id='google_cloud_default', 
             impersonation_chain=None,
+            staging='stream', # "stream" uploads while writing, "local" stages the output in a temporary file
+            compression=None, # None or "gzip", compresses the output on the fly
+            compression_level=6, # 1 (fastest) to 9 (smallest)
             *args, **kwargs):
         super(BigQueryTableSchemaToGoogleCloudStorage, self).__init__(*args, **kwargs)
         self.source_dataset_id = source_dataset_id
@@ -43,6 +47,9 @@ class BigQueryTableSchemaToGoogleCloudStorage(BaseOperator):
         self.destination_gcs_filepath = destination_gcs_filepath
         self.gcp_conn_id = gcp_conn_id
         self.impersonation_chain = impersonation_chain
+        self.staging = staging
+        self.compression = compression
+        self.compression_level = compression_level
 
         log.setLevel(logging.INFO)
 
@@ -62,13 +69,6 @@ class BigQueryTableSchemaToGoogleCloudStorage(BaseOperator):
         schema = bq_hook.get_schema(dataset_id=self.source_dataset_id, table_id=self.source_table_id)
 
         # write to GCS
-        with NamedTemporaryFile("w") as f:
-            json.dump(schema, f)
-            f.flush()
-            gcs_hook.upload(
-                self.destination_gcs_bucket, 
-                self.destination_gcs_filepath, 
-                filename=f.name, 
-                mime_type="application/json; charset=utf-8"
-            )
-
+        with open_gcs_sink(gcs_hook, self.destination_gcs_bucket, self.destination_gcs_filepath, text=False, staging=self.staging,
+                compression=self.compression, compression_level=self.compression_level) as f:
+            f.write(json_codec.dumps(schema))
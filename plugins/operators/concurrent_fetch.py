@@ -0,0 +1,160 @@
+"""
+
+Helpers to fan out API calls (and CPU bound transformations) of the transfer
+operators over bounded worker pools
+
+"""
+
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class ThreadLocalHook(object):
+    """
+    Lazily creates one hook instance per thread.
+
+    The HttpHook based hooks keep per call state (method, retry object) on
+    the instance, so they must not be shared between threads. The pooled
+    HTTP session behind them is still shared by all instances.
+    """
+
+    def __init__(self, hook_factory):
+        self.hook_factory = hook_factory
+        self._local = threading.local()
+
+    def get(self):
+        hook = getattr(self._local, "hook", None)
+        if hook is None:
+            hook = self.hook_factory()
+            self._local.hook = hook
+        return hook
+
+
+def ordered_map(func, items, max_concurrency=1, max_pending=None, processes=False):
+    """
+    Applies func to every item and yields the results in input order.
+
+    Up to max_concurrency calls run at the same time and at most max_pending
+    results are buffered, so memory stays bounded for long item streams.
+    The first exception cancels all work not yet started, waits for the
+    running calls and is then re-raised to the consumer.
+
+    :param func: callable applied to each item
+    :type func: callable
+    :param items: items to process, may be a generator
+    :type items: iterable
+    :param max_concurrency: number of worker threads, 1 runs inline
+    :type max_concurrency: int
+    :param max_pending: number of submitted but not yet consumed items (default 2 * max_concurrency)
+    :type max_pending: int
+    :param processes: run func in worker processes (for CPU bound work), func
+        and items must then be picklable
+    :type processes: bool
+    """
+
+    if max_concurrency is None or max_concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    max_pending = max_pending or 2 * max_concurrency
+
+    if processes:
+        # spawn, forking a process running upload and fetch threads can deadlock
+        executor = ProcessPoolExecutor(max_workers=max_concurrency, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+_ELEMENT, _ERROR, _DONE = object(), object(), object()
+
+
+def interleave(func, items, max_concurrency=1, max_pending=None):
+    """
+    Runs the generator function func for every item and yields the produced
+    elements as soon as they are available.
+
+    Elements of one item keep their order, elements of different items are
+    interleaved. At most max_pending elements are buffered, so producers
+    block while the consumer is busy writing. The first exception stops all
+    producers and is re-raised to the consumer.
+
+    :param func: generator function applied to each item
+    :type func: callable
+    :param items: items to process
+    :type items: iterable
+    :param max_concurrency: number of worker threads, 1 runs inline
+    :type max_concurrency: int
+    :param max_pending: number of buffered elements (default 2 * max_concurrency)
+    :type max_pending: int
+    """
+
+    if max_concurrency is None or max_concurrency <= 1:
+        for item in items:
+            yield from func(item)
+        return
+
+    buffer = queue.Queue(maxsize=max_pending or 2 * max_concurrency)
+    stopped = threading.Event()
+    items = iter(items)
+    items_lock = threading.Lock()
+
+    def put(message):
+        # give up once the consumer stopped, it will not drain the buffer anymore
+        while not stopped.is_set():
+            try:
+                buffer.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work():
+        try:
+            while not stopped.is_set():
+                with items_lock:
+                    item = next(items, _DONE)
+                if item is _DONE:
+                    break
+                for element in func(item):
+                    if not put((_ELEMENT, element)):
+                        return
+        except Exception as e:
+            put((_ERROR, e))
+        finally:
+            put((_DONE, None))
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(max_concurrency)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        running = len(workers)
+        while running:
+            kind, payload = buffer.get()
+            if kind is _DONE:
+                running -= 1
+            elif kind is _ERROR:
+                raise payload
+            else:
+                yield payload
+    finally:
+        stopped.set()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,440 @@
+"""
+
+Streaming sink writing operator output to Google Cloud Storage
+
+"""
+
+import base64
+import gzip
+import hashlib
+import io
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+from google.cloud.storage.retry import DEFAULT_RETRY
+
+JSON_MIME_TYPE = "application/json; charset=utf-8"
+
+# resumable upload chunks must be a multiple of 256 KiB
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# supported compressions with their content encoding and object name suffix
+COMPRESSIONS = {
+    "gzip": ("gzip", ".gz"),
+}
+
+
+def compressed_object_name(object_name, compression):
+    """Appends the file suffix of the compression to the object name (if missing)."""
+
+    if not compression:
+        return object_name
+
+    suffix = COMPRESSIONS[compression][1]
+    return object_name if object_name.endswith(suffix) else object_name + suffix
+
+
+class GCSStreamingUpload(io.RawIOBase):
+    """
+    Raw binary stream uploading to GCS with a resumable upload while it is
+    written.
+
+    Written bytes are collected into chunks of chunk_size which are sent by a
+    background thread, so producing data and uploading overlap. At most
+    max_pending_chunks chunks wait for the upload, the writer blocks
+    beyond that. The object is only created by commit(), closing the stream
+    without committing discards the upload.
+    """
+
+    def __init__(self, gcs_hook, bucket_name, object_name, mime_type=JSON_MIME_TYPE,
+            chunk_size=DEFAULT_CHUNK_SIZE, max_pending_chunks=2, content_encoding=None):
+        super(GCSStreamingUpload, self).__init__()
+        blob = gcs_hook.get_conn().bucket(bucket_name).blob(object_name)
+        blob.content_encoding = content_encoding
+        self._writer = blob.open("wb", chunk_size=chunk_size, content_type=mime_type, ignore_flush=True, retry=DEFAULT_RETRY)
+
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._chunks = queue.Queue(maxsize=max_pending_chunks)
+        self._error = None
+        self._committed = False
+        self._aborted = False
+        self._thread = threading.Thread(target=self._upload, daemon=True)
+        self._thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self._aborted:
+            return len(b)
+        self._raise_upload_error()
+
+        self._buffer += b
+        if len(self._buffer) >= self._chunk_size:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        return len(b)
+
+    def commit(self):
+        """Uploads the remaining bytes and finalizes the object."""
+
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._stop()
+        self._raise_upload_error()
+
+        self._writer.close()
+        self._committed = True
+
+    def abort(self):
+        """Discards the upload, no object is created."""
+
+        self._aborted = True
+        self._buffer = bytearray()
+        self._stop()
+
+        # BlobWriter.close() finalizes the object, terminate() cancels the
+        # resumable session instead and leaves the writer closed, so the
+        # garbage collector (IOBase.__del__) cannot finalize the partial upload
+        self._writer.terminate()
+
+    def close(self):
+        if not self.closed and not self._committed:
+            self.abort()
+        super(GCSStreamingUpload, self).close()
+
+    def _put(self, chunk):
+        while True:
+            self._raise_upload_error()
+            try:
+                self._chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._chunks.put(None)
+            self._thread.join()
+
+    def _upload(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+
+            # keep draining after a failure so the writer never blocks
+            if self._error is None:
+                try:
+                    self._writer.write(chunk)
+                except Exception as e:
+                    self._error = e
+
+    def _raise_upload_error(self):
+        if self._error is not None:
+            raise self._error
+
+
+def _wrap_output(fileobj, text, compression, compression_level):
+    if compression == "gzip":
+        # fixed mtime keeps the output of identical data byte for byte identical
+        compressed = gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=compression_level, mtime=0)
+    elif compression:
+        raise ValueError(f"Unsupported compression {compression}")
+    else:
+        compressed = fileobj
+
+    f = io.TextIOWrapper(compressed, encoding="utf-8") if text else compressed
+
+    def finish():
+        # write all pending data (and the compression trailer) to fileobj
+        f.flush()
+        if compressed is not fileobj:
+            compressed.close()
+
+    return f, finish
+
+
+@contextmanager
+def open_gcs_sink(gcs_hook, bucket_name, object_name, mime_type=JSON_MIME_TYPE, text=True,
+        staging="stream", buffer_size=io.DEFAULT_BUFFER_SIZE, chunk_size=DEFAULT_CHUNK_SIZE,
+        compression=None, compression_level=6):
+    """
+    Opens a file object whose content is uploaded to gs://bucket_name/object_name
+    when the context exits without an error.
+
+    :param gcs_hook: GCS hook used for the upload
+    :type gcs_hook: GCSHook
+    :param text: yield a utf-8 text file instead of a binary one
+    :type text: bool
+    :param staging: "stream" uploads while writing, "local" stages the output
+        in a temporary file and uploads it at the end
+    :type staging: string
+    :param buffer_size: write buffer of the yielded file object
+    :type buffer_size: int
+    :param chunk_size: resumable upload chunk size in stream mode
+    :type chunk_size: int
+    :param compression: compress the output on the fly (None or "gzip"), the
+        object gets the matching content encoding and file suffix (appended to
+        object_name unless already present)
+    :type compression: string
+    :param compression_level: 1 (fastest) to 9 (smallest)
+    :type compression_level: int
+    """
+
+    content_encoding = COMPRESSIONS[compression][0] if compression else None
+    object_name = compressed_object_name(object_name, compression)
+
+    if staging == "local":
+        with NamedTemporaryFile("wb", buffering=buffer_size) as tmp_file:
+            f, finish = _wrap_output(tmp_file, text, compression, compression_level)
+            yield f
+            finish()
+            tmp_file.flush()
+
+            if content_encoding:
+                blob = gcs_hook.get_conn().bucket(bucket_name).blob(object_name)
+                blob.content_encoding = content_encoding
+                blob.upload_from_filename(tmp_file.name, content_type=mime_type, retry=DEFAULT_RETRY)
+            else:
+                gcs_hook.upload(bucket_name, object_name, filename=tmp_file.name, mime_type=mime_type)
+        return
+
+    if staging != "stream":
+        raise ValueError(f"Unsupported staging {staging}")
+
+    upload = GCSStreamingUpload(gcs_hook, bucket_name, object_name, mime_type=mime_type, chunk_size=chunk_size,
+        content_encoding=content_encoding)
+    buffered = io.BufferedWriter(upload, buffer_size)
+    f, finish = _wrap_output(buffered, text, compression, compression_level)
+
+    try:
+        yield f
+        finish()
+        buffered.flush()
+        upload.commit()
+    except BaseException:
+        upload.abort()
+        raise
+    finally:
+        f.close()
+        buffered.close()
+
+
+def shard_name_template(object_name):
+    """
+    Returns the str.format template of the shard object names: object_name
+    itself if it contains a {shard} field, else object_name with
+    "-{shard:05d}" inserted before the extension.
+    """
+
+    if "{shard" in object_name:
+        return object_name
+
+    path, dot, extension = object_name.rpartition(".")
+    if not dot or "/" in extension:
+        return object_name + "-{shard:05d}"
+    return path + "-{shard:05d}." + extension
+
+
+class ShardedGCSSink(object):
+    """
+    Binary sink for newline delimited data writing a sequence of GCS objects
+    (shards), named by shard_name_template.format(shard=index).
+
+    A new shard is started once the current one holds max_shard_bytes
+    (uncompressed) bytes or max_shard_records lines, shards are only split
+    at line boundaries. Every shard is written through open_gcs_sink with
+    the given keyword arguments (e.g. staging, compression). Finished shards
+    are finalized (the remaining bytes, or with staging="local" the whole
+    staged file, uploaded and the object committed) by background threads
+    while the next shard is written, the writer blocks while
+    max_pending_uploads shards are in progress.
+    """
+
+    def __init__(self, gcs_hook, bucket_name, shard_name_template, max_shard_bytes=None, max_shard_records=None,
+            max_pending_uploads=2, **sink_kwargs):
+        self.gcs_hook = gcs_hook
+        self.bucket_name = bucket_name
+        self.shard_name_template = shard_name_template
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_records = max_shard_records
+        self.max_pending_uploads = max_pending_uploads
+        self.sink_kwargs = dict(sink_kwargs, text=False)
+        self.object_names = []
+
+        self._executor = ThreadPoolExecutor(max_workers=max_pending_uploads)
+        self._pending = deque()
+        self._shard = None
+        self._shard_file = None
+        self._shard_bytes = 0
+        self._shard_records = 0
+
+    def write(self, data):
+        size = len(data)
+        while data:
+            if self._shard is None:
+                self._open_shard()
+
+            end = self._shard_end(data)
+            if end is None:
+                self._shard_file.write(data)
+                self._shard_bytes += len(data)
+                self._shard_records += data.count(b"\n")
+                break
+
+            self._shard_file.write(data[:end])
+            self._finish_shard()
+            data = data[end:]
+
+        return size
+
+    def close(self):
+        """Finalizes all shards and deletes shards left over by previous runs with more shards."""
+
+        # an empty output still gets one (empty) shard
+        if self._shard is None and not self.object_names:
+            self._open_shard()
+        if self._shard is not None:
+            self._finish_shard()
+
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            self._executor.shutdown()
+
+        index = len(self.object_names)
+        while True:
+            stale_object_name = self._object_name(index)
+            if not self.gcs_hook.exists(self.bucket_name, stale_object_name):
+                break
+            self.gcs_hook.delete(self.bucket_name, stale_object_name)
+            index += 1
+
+    def abort(self):
+        """Discards the current shard, finished shards are still finalized."""
+
+        if self._shard is not None:
+            shard, self._shard, self._shard_file = self._shard, None, None
+            aborted = InterruptedError("Sharded upload aborted")
+            shard.__exit__(InterruptedError, aborted, None)
+
+        for future in self._pending:
+            future.exception()
+        self._executor.shutdown()
+
+    def manifest(self):
+        """
+        Returns the shard URIs and a wildcard URI matching all shards (for
+        BigQuery loads, the wildcard replaces everything from the {shard} field on).
+        """
+
+        wildcard_prefix = self.shard_name_template.split("{", 1)[0]
+        return {
+            "uris": [f"gs://{self.bucket_name}/{object_name}" for object_name in self.object_names],
+            "wildcard_uri": f"gs://{self.bucket_name}/{wildcard_prefix}*",
+        }
+
+    def _object_name(self, index):
+        return compressed_object_name(self.shard_name_template.format(shard=index), self.sink_kwargs.get("compression"))
+
+    def _shard_end(self, data):
+        # offset in data after the line break completing the current shard, None if data fits
+        ends = []
+
+        if self.max_shard_records:
+            position = -1
+            for _ in range(self.max_shard_records - self._shard_records):
+                position = data.find(b"\n", position + 1)
+                if position < 0:
+                    break
+            else:
+                ends.append(position + 1)
+
+        if self.max_shard_bytes:
+            position = data.find(b"\n", max(self.max_shard_bytes - self._shard_bytes - 1, 0))
+            if position >= 0:
+                ends.append(position + 1)
+
+        return min(ends) if ends else None
+
+    def _open_shard(self):
+        object_name = self._object_name(len(self.object_names))
+        self._shard = open_gcs_sink(self.gcs_hook, self.bucket_name, object_name, **self.sink_kwargs)
+        self._shard_file = self._shard.__enter__()
+        self._shard_bytes = 0
+        self._shard_records = 0
+        self.object_names.append(object_name)
+
+    def _finish_shard(self):
+        while len(self._pending) >= self.max_pending_uploads:
+            self._pending.popleft().result()
+
+        shard, self._shard, self._shard_file = self._shard, None, None
+        self._pending.append(self._executor.submit(shard.__exit__, None, None, None))
+
+
+@contextmanager
+def open_sharded_gcs_sink(gcs_hook, bucket_name, object_name, max_shard_bytes=None, max_shard_records=None,
+        max_pending_uploads=2, **sink_kwargs):
+    """
+    Opens a ShardedGCSSink writing the shards named by shard_name_template(object_name),
+    all shards are finalized when the context exits without an error.
+    """
+
+    sink = ShardedGCSSink(gcs_hook, bucket_name, shard_name_template(object_name),
+        max_shard_bytes=max_shard_bytes, max_shard_records=max_shard_records,
+        max_pending_uploads=max_pending_uploads, **sink_kwargs)
+    try:
+        yield sink
+    except BaseException:
+        sink.abort()
+        raise
+    sink.close()
+
+
+def upload_if_changed(gcs_hook, bucket_name, object_name, data, mime_type=JSON_MIME_TYPE,
+        compression=None, compression_level=6, skip_unchanged=True):
+    """
+    Uploads small in-memory data unless the object already has the same content.
+
+    The content is compared with the md5 hash GCS keeps for the object (and
+    the sha256 metadata set by this function for objects without md5, e.g.
+    composed ones). Compressed data is deterministic, so compression does
+    not hide unchanged content.
+
+    :param data: content to upload
+    :type data: bytes
+    :param skip_unchanged: compare with the existing object, False always uploads
+    :type skip_unchanged: bool
+    :return: whether the object was (re)written
+    """
+
+    if compression:
+        data = gzip.compress(data, compresslevel=compression_level, mtime=0)
+    object_name = compressed_object_name(object_name, compression)
+
+    md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+    sha256_hash = hashlib.sha256(data).hexdigest()
+
+    bucket = gcs_hook.get_conn().bucket(bucket_name)
+    if skip_unchanged:
+        existing_blob = bucket.get_blob(object_name)
+        if existing_blob is not None and (
+                existing_blob.md5_hash == md5_hash or (existing_blob.metadata or {}).get("sha256") == sha256_hash):
+            return False
+
+    blob = bucket.blob(object_name)
+    blob.content_encoding = COMPRESSIONS[compression][0] if compression else None
+    blob.metadata = {"sha256": sha256_hash}
+    blob.upload_from_string(data, content_type=mime_type, retry=DEFAULT_RETRY)
+
+    return True
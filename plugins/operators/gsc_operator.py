@@ -1,16 +1,16 @@
 from __future__ import annotations
 
-import json
 from datetime import datetime
-from tempfile import NamedTemporaryFile
-from typing import Any, Callable, List, Mapping, Sequence
+from typing import IO, Any, Callable, List, Mapping, Sequence
 
 from airflow.providers.google.cloud.hooks.gcs import GCSHook
 from airflow.providers.google.cloud.operators.cloud_base import GoogleCloudBaseOperator
 from airflow.sensors.python import PythonSensor
 from airflow.utils.context import Context
 
+from hooks import json_codec
 from hooks.gsc_hook import GscHook
+from operators.gcs_sink import compressed_object_name, open_gcs_sink
 
 
 def get_data_availability(**kwargs) -> bool:
@@ -58,6 +58,9 @@ class GoogleSearchConsoleToGcsOperator(GoogleCloudBaseOperator):
             gcs_gcp_conn_id: str = 'google_cloud_default',
             gcs_bucket: str = None,
             gcs_filepath: str = None,
+            staging: str = 'stream',
+            compression: str | None = None,
+            compression_level: int = 6,
             **kwargs):
         super().__init__(**kwargs)
         self.gsc_gcp_conn_id = gsc_gcp_conn_id
@@ -73,6 +76,9 @@ class GoogleSearchConsoleToGcsOperator(GoogleCloudBaseOperator):
         self.gcs_gcp_conn_id = gcs_gcp_conn_id
         self.gcs_bucket = gcs_bucket
         self.gcs_filepath = gcs_filepath
+        self.staging = staging
+        self.compression = compression
+        self.compression_level = compression_level
 
     def execute(self, context: Context) -> None:
         gsc_hook = GscHook(
@@ -84,14 +90,12 @@ class GoogleSearchConsoleToGcsOperator(GoogleCloudBaseOperator):
             gcp_conn_id=self.gcs_gcp_conn_id
         )
 
-        with NamedTemporaryFile('w') as tmp_file:
+        self.log.info(f'Writing to gs://{self.gcs_bucket}/{compressed_object_name(self.gcs_filepath, self.compression)}')
+        with open_gcs_sink(gcs_hook, self.gcs_bucket, self.gcs_filepath, text=False, staging=self.staging,
+                           compression=self.compression, compression_level=self.compression_level) as tmp_file:
             self._write_data_to_file(gsc_hook, tmp_file)
 
-            self.log.info(f'Uploading {tmp_file.name} to gs://{self.gcs_bucket}/{self.gcs_filepath}')
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=tmp_file.name,
-                            mime_type="application/json; charset=utf-8")
-
-    def _write_data_to_file(self, gsc_hook: GscHook, tmp_file: NamedTemporaryFile) -> None:
+    def _write_data_to_file(self, gsc_hook: GscHook, tmp_file: IO[bytes]) -> None:
         for type in self.types:
             row_limit = 25000
             start_row = 0
@@ -105,8 +109,9 @@ class GoogleSearchConsoleToGcsOperator(GoogleCloudBaseOperator):
                     self.log.info('Stopping here, no rows to fetch.')
                     break
 
-                for row in result['rows']:
-                    searchanalytics_data = {
+                load_date = datetime.utcnow().isoformat()
+                searchanalytics_data = [
+                    {
                         'date': self.date,
                         'property': self.site_url,
                         'type': type,
@@ -117,11 +122,11 @@ class GoogleSearchConsoleToGcsOperator(GoogleCloudBaseOperator):
                         'impressions': row['impressions'],
                         'position': row['position'],
                         'ctr': row['ctr'],
-                        'load_date': datetime.utcnow().isoformat()
+                        'load_date': load_date
                     }
-
-                    json.dump(searchanalytics_data, tmp_file)
-                    tmp_file.write('\n')
+                    for row in result['rows']
+                ]
+                tmp_file.write(json_codec.dump_lines(searchanalytics_data))
 
                 row_count = len(result["rows"])
                 self.log.info(f'Fetched {row_count} rows.')
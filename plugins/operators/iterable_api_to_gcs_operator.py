@@ -6,19 +6,56 @@ Iterable API to Google Cloud Storage transfer operator
 import hashlib
 import json
 import logging
+import os
+import threading
 from datetime import datetime
 from datetime import timezone
-from tempfile import NamedTemporaryFile
+from functools import partial
 
+from airflow.exceptions import AirflowException, AirflowFailException
 from airflow.models import BaseOperator
 from airflow.providers.google.cloud.hooks.gcs import GCSHook
 
+from hooks import json_codec
 from hooks.iterable_api_hook import IterableAPIHook
+from hooks.request_metrics import report_request_metrics
+from operators.concurrent_fetch import ThreadLocalHook, interleave, ordered_map
+from operators.gcs_sink import COMPRESSIONS, compressed_object_name, open_gcs_sink, open_sharded_gcs_sink, upload_if_changed
+from operators.parquet_writer import PARQUET_MIME_TYPE, ParquetRecordWriter
+from operators.record_pipeline import add_hashed_user_id, batched, transform_lines
+from triggers.iterable_export_trigger import IterableExportTrigger
 
 log = logging.getLogger(__name__)
 
 
+def _open_json_output(gcs_hook, bucket_name, object_name, max_shard_bytes=None, max_shard_records=None,
+        shard_uploads=2, **sink_kwargs):
+    # binary newline delimited json output, sharded once a shard limit is set
+    if max_shard_bytes or max_shard_records:
+        return open_sharded_gcs_sink(gcs_hook, bucket_name, object_name, max_shard_bytes=max_shard_bytes,
+            max_shard_records=max_shard_records, max_pending_uploads=shard_uploads, **sink_kwargs)
+    return open_gcs_sink(gcs_hook, bucket_name, object_name, text=False, **sink_kwargs)
+
+
+def _publish_shard_manifest(context, gcs_hook, bucket_name, manifest_filepath, manifest):
+    # the manifest is pushed to XCom and, if requested, uploaded next to the shards
+    log.info("Wrote %s shards matching %s", len(manifest["uris"]), manifest["wildcard_uri"])
+    context["ti"].xcom_push(key="shards", value=manifest)
+    if manifest_filepath:
+        gcs_hook.upload(
+            bucket_name,
+            manifest_filepath,
+            data=json_codec.dumps(manifest),
+            mime_type="application/json; charset=utf-8"
+        )
+
+
 class IterableCampaignsAPIToGoogleCloudStorage(BaseOperator):
+    """
+    Uploads the full dataset on every run unless it did not change (with
+    skip_unchanged=True), whether it was uploaded is pushed to XCom with key
+    "changed" so downstream tasks can short-circuit.
+    """
 
     template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath']
 
@@ -28,13 +65,20 @@ class IterableCampaignsAPIToGoogleCloudStorage(BaseOperator):
             gcp_conn_id='google_cloud_default',
             gcs_bucket=None,
             gcs_filepath=None,
+            skip_unchanged=False, # do not upload when the object already has the same content
+            compression=None, # None or "gzip", compresses the output on the fly
+            compression_level=6, # 1 (fastest) to 9 (smallest)
             *args, **kwargs):
         super(IterableCampaignsAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
         self.itr_conn_id = itr_conn_id
         self.gcp_conn_id = gcp_conn_id
         self.gcs_bucket = gcs_bucket
         self.gcs_filepath = gcs_filepath
+        self.skip_unchanged = skip_unchanged
+        self.compression = compression
+        self.compression_level = compression_level
 
+    @report_request_metrics
     def execute(self, context):
         # initialize hooks to Iterable and GCS
         iterable_api_hook = IterableAPIHook(
@@ -46,23 +90,23 @@ class IterableCampaignsAPIToGoogleCloudStorage(BaseOperator):
 
         # fetch JSON data from API 
         data_r = iterable_api_hook.campaigns()
-        campaigns = json.loads(data_r.text)["campaigns"]
+        records = json_codec.loads(data_r.content)["campaigns"]
 
-        # compute increment
-        records = []
-        for campaign in campaigns:
-            records.append(campaign)
-        
-        # convert records array to newline delimited json and upload to gcs
-        with NamedTemporaryFile("w") as f:
-            for record in records:
-                json.dump(record, f)
-                f.write('\n')
-            f.flush()
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=f.name, mime_type="application/json; charset=utf-8")
+        # convert records array to newline delimited json and upload to gcs (if changed)
+        data = json_codec.dump_lines(records)
+        changed = upload_if_changed(gcs_hook, self.gcs_bucket, self.gcs_filepath, data,
+            compression=self.compression, compression_level=self.compression_level, skip_unchanged=self.skip_unchanged)
+        log.info("gs://%s/%s %s", self.gcs_bucket, self.gcs_filepath, "updated" if changed else "unchanged, skipped upload")
+
+        context["ti"].xcom_push(key="changed", value=changed)
 
 
 class IterableChannelsAPIToGoogleCloudStorage(BaseOperator):
+    """
+    Uploads the full dataset on every run unless it did not change (with
+    skip_unchanged=True), whether it was uploaded is pushed to XCom with key
+    "changed" so downstream tasks can short-circuit.
+    """
 
     template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath']
 
@@ -72,13 +116,20 @@ class IterableChannelsAPIToGoogleCloudStorage(BaseOperator):
             gcp_conn_id='google_cloud_default',
             gcs_bucket=None,
             gcs_filepath=None,
+            skip_unchanged=False, # do not upload when the object already has the same content
+            compression=None, # None or "gzip", compresses the output on the fly
+            compression_level=6, # 1 (fastest) to 9 (smallest)
             *args, **kwargs):
         super(IterableChannelsAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
         self.itr_conn_id = itr_conn_id
         self.gcp_conn_id = gcp_conn_id
         self.gcs_bucket = gcs_bucket
         self.gcs_filepath = gcs_filepath
+        self.skip_unchanged = skip_unchanged
+        self.compression = compression
+        self.compression_level = compression_level
 
+    @report_request_metrics
     def execute(self, context):
         # initialize hooks to Iterable and GCS
         iterable_api_hook = IterableAPIHook(
@@ -90,18 +141,23 @@ class IterableChannelsAPIToGoogleCloudStorage(BaseOperator):
         
         # fetch JSON data from API 
         data_r = iterable_api_hook.channels()
-        records = json.loads(data_r.text)["channels"]
+        records = json_codec.loads(data_r.content)["channels"]
+
+        # convert records array to newline delimited json and upload to gcs (if changed)
+        data = json_codec.dump_lines(records)
+        changed = upload_if_changed(gcs_hook, self.gcs_bucket, self.gcs_filepath, data,
+            compression=self.compression, compression_level=self.compression_level, skip_unchanged=self.skip_unchanged)
+        log.info("gs://%s/%s %s", self.gcs_bucket, self.gcs_filepath, "updated" if changed else "unchanged, skipped upload")
 
-        # convert records array to newline delimited json and upload to gcs
-        with NamedTemporaryFile("w") as f:
-            for record in records:
-                json.dump(record, f)
-                f.write('\n')
-            f.flush()
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=f.name, mime_type="application/json; charset=utf-8")
+        context["ti"].xcom_push(key="changed", value=changed)
 
 
 class IterableMessageTypesAPIToGoogleCloudStorage(BaseOperator):
+    """
+    Uploads the full dataset on every run unless it did not change (with
+    skip_unchanged=True), whether it was uploaded is pushed to XCom with key
+    "changed" so downstream tasks can short-circuit.
+    """
 
     template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath']
 
@@ -111,13 +167,20 @@ class IterableMessageTypesAPIToGoogleCloudStorage(BaseOperator):
             gcp_conn_id='google_cloud_default',
             gcs_bucket=None,
             gcs_filepath=None,
+            skip_unchanged=False, # do not upload when the object already has the same content
+            compression=None, # None or "gzip", compresses the output on the fly
+            compression_level=6, # 1 (fastest) to 9 (smallest)
             *args, **kwargs):
         super(IterableMessageTypesAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
         self.itr_conn_id = itr_conn_id
         self.gcp_conn_id = gcp_conn_id
         self.gcs_bucket = gcs_bucket
         self.gcs_filepath = gcs_filepath
+        self.skip_unchanged = skip_unchanged
+        self.compression = compression
+        self.compression_level = compression_level
 
+    @report_request_metrics
     def execute(self, context):
         # initialize hooks to Iterable and GCS
         iterable_api_hook = IterableAPIHook(
@@ -129,20 +192,33 @@ class IterableMessageTypesAPIToGoogleCloudStorage(BaseOperator):
         
         # fetch JSON data from API 
         data_r = iterable_api_hook.message_types()
-        records = json.loads(data_r.text)["messageTypes"]
+        records = json_codec.loads(data_r.content)["messageTypes"]
 
-        # convert records array to newline delimited json and upload to gcs
-        with NamedTemporaryFile("w") as f:
-            for record in records:
-                json.dump(record, f)
-                f.write('\n')
-            f.flush()
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=f.name, mime_type="application/json; charset=utf-8")
+        # convert records array to newline delimited json and upload to gcs (if changed)
+        data = json_codec.dump_lines(records)
+        changed = upload_if_changed(gcs_hook, self.gcs_bucket, self.gcs_filepath, data,
+            compression=self.compression, compression_level=self.compression_level, skip_unchanged=self.skip_unchanged)
+        log.info("gs://%s/%s %s", self.gcs_bucket, self.gcs_filepath, "updated" if changed else "unchanged, skipped upload")
 
+        context["ti"].xcom_push(key="changed", value=changed)
 
-class IterableEmailTemplateAPIToGoogleCloudStorage(BaseOperator):
 
-    template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath', 'updated_at_start_date', 'updated_at_end_date']
+class IterableEmailTemplateAPIToGoogleCloudStorage(BaseOperator):
+    """
+    Exports the Iterable email templates updated within a date range.
+
+    With manifest_gcs_filepath the operator keeps a manifest of the exported
+    templates (templateId -> [updatedAt, content hash]) in GCS. Templates
+    whose updatedAt matches the manifest are not fetched again, so the
+    output only contains the delta: the templates new or updated since the
+    previous run, not all templates of the window. With
+    skip_unchanged_content=True fetched templates whose content (all but
+    createdAt/updatedAt) matches the manifest are not written either. When
+    no template is left to write, gcs_filepath is not uploaded and keeps
+    its previous content, e.g. on a rerun of an already exported window.
+    """
+
+    template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath', 'updated_at_start_date', 'updated_at_end_date', 'manifest_gcs_filepath']
 
     def __init__(
             self,
@@ -152,60 +228,135 @@ class IterableEmailTemplateAPIToGoogleCloudStorage(BaseOperator):
             gcs_filepath=None,
             updated_at_start_date=None, # Accepts yyyy-MM-ddTHH:mm:ss+00:00
             updated_at_end_date=None, # Accepts yyyy-MM-ddTHH:mm:ss+00:00
+            max_concurrency=1, # number of parallel API calls
+            staging='stream', # "stream" uploads while writing, "local" stages the output in a temporary file
+            compression=None, # None or "gzip", compresses the output on the fly
+            compression_level=6, # 1 (fastest) to 9 (smallest)
+            manifest_gcs_filepath=None, # manifest of exported templates in gcs_bucket, enables incremental sync
+            skip_unchanged_content=False, # with a manifest, also drop updated templates whose content did not change
             *args, **kwargs):
         super(IterableEmailTemplateAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
         self.itr_conn_id = itr_conn_id
         self.gcp_conn_id = gcp_conn_id
         self.gcs_bucket = gcs_bucket
         self.gcs_filepath = gcs_filepath
+        self.staging = staging
+        self.compression = compression
+        self.compression_level = compression_level
         self.updated_at_start_date = updated_at_start_date
         self.updated_at_end_date = updated_at_end_date
+        self.max_concurrency = max_concurrency
+        self.manifest_gcs_filepath = manifest_gcs_filepath
+        self.skip_unchanged_content = skip_unchanged_content
 
+    @report_request_metrics
     def execute(self, context):
-        # initialize hooks to Iterable and GCS
-        iterable_api_hook = IterableAPIHook(
-            itr_conn_id=self.itr_conn_id
+        # initialize hooks to Iterable (one per worker thread) and GCS
+        iterable_api_hooks = ThreadLocalHook(
+            lambda: IterableAPIHook(itr_conn_id=self.itr_conn_id)
         )
         gcs_hook = GCSHook(
             gcp_conn_id=self.gcp_conn_id
         )
         
         # fetch JSON template data from API 
+        def fetch_templates(template_type):
+            data_r = iterable_api_hooks.get().templates(
+                template_type=template_type, message_medium="Email")
+            return json_codec.loads(data_r.content)["templates"]
+
         templates = []
         template_types = ["Base", "Blast", "Triggered", "Workflow"]
-        message_medium = "Email"
-        for template_type in template_types:
-            data_r = iterable_api_hook.templates(
-                template_type=template_type,message_medium=message_medium)
-            templates.extend(
-                json.loads(data_r.text)["templates"])
+        for type_templates in ordered_map(fetch_templates, template_types, self.max_concurrency):
+            templates.extend(type_templates)
+
+        # only fetch email templates updated within the requested window
+        updated_at_start_date = datetime.fromisoformat(self.updated_at_start_date)
+        updated_at_end_date = datetime.fromisoformat(self.updated_at_end_date)
+        templates = [
+            template for template in templates
+            if updated_at_start_date <= datetime.fromtimestamp(template["updatedAt"] / 1000.0, tz=timezone.utc) < updated_at_end_date # updatedAt is in timestamp millis
+        ]
+
+        # skip templates not updated since they were last exported
+        manifest = self._load_manifest(gcs_hook) if self.manifest_gcs_filepath else {}
+        templates = [
+            template for template in templates
+            if manifest.get(str(template["templateId"]), [None])[0] != template["updatedAt"]
+        ]
+        log.info("Fetching %s new or updated email templates", len(templates))
 
         # fetch JSON email template data from API 
-        records = []
-        for template in templates:
-            template_id = template["templateId"]
-            updated_at = datetime.fromtimestamp(template["updatedAt"] / 1000.0, tz=timezone.utc) # updatedAt is in timestamp millis
-            if updated_at >= datetime.fromisoformat(self.updated_at_start_date) and \
-                    updated_at < datetime.fromisoformat(self.updated_at_end_date):
-                data_r = iterable_api_hook.email_template(
-                    template_id=template_id)
-                record = json.loads(data_r.text)
-                record["createdAt"] = template["createdAt"] # email template createdAt is project template createdAt
-                record["updatedAt"] = template["updatedAt"] # email template updatedAt is project template updatedAt
-                records.append(record)
-
-        # convert records array to newline delimited json and upload to gcs
-        with NamedTemporaryFile("w") as f:
-            for record in records:
-                json.dump(record, f)
-                f.write('\n')
-            f.flush()
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=f.name, mime_type="application/json; charset=utf-8")
+        def fetch_email_template(template):
+            data_r = iterable_api_hooks.get().email_template(
+                template_id=template["templateId"])
+            record = json_codec.loads(data_r.content)
+            record["createdAt"] = template["createdAt"] # email template createdAt is project template createdAt
+            record["updatedAt"] = template["updatedAt"] # email template updatedAt is project template updatedAt
+            return template, record, self._content_hash(record)
+
+        def records_to_write():
+            for template, record, content_hash in ordered_map(fetch_email_template, templates, self.max_concurrency):
+                template_id = str(template["templateId"])
+                unchanged = manifest.get(template_id, [None, None])[1] == content_hash
+                manifest[template_id] = [template["updatedAt"], content_hash]
+                if unchanged and self.skip_unchanged_content:
+                    continue
+
+                yield record
+
+        # only open the sink once there is a record to write, so a rerun
+        # without new or updated templates keeps the previous output
+        records = records_to_write()
+        first_record = next(records, None)
+        if first_record is None:
+            log.info("No new or updated email templates, skipped upload to gs://%s/%s", self.gcs_bucket, self.gcs_filepath)
+        else:
+            # convert records to newline delimited json (in template order) and upload to gcs
+            with open_gcs_sink(gcs_hook, self.gcs_bucket, self.gcs_filepath, text=False, staging=self.staging,
+                    compression=self.compression, compression_level=self.compression_level) as f:
+                f.write(json_codec.dump_line(first_record))
+                for record in records:
+                    f.write(json_codec.dump_line(record))
+
+        # only record the templates once the output is uploaded
+        if self.manifest_gcs_filepath:
+            self._save_manifest(gcs_hook, manifest)
+
+    @staticmethod
+    def _content_hash(record):
+        # timestamps change without content changes, only hash the content
+        # (with stdlib json, the hash must not depend on the installed json backend)
+        content = {key: value for key, value in record.items() if key not in ("createdAt", "updatedAt")}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _load_manifest(self, gcs_hook):
+        if not gcs_hook.exists(self.gcs_bucket, self.manifest_gcs_filepath):
+            return {}
+        return json_codec.loads(gcs_hook.download(self.gcs_bucket, self.manifest_gcs_filepath))
+
+    def _save_manifest(self, gcs_hook, manifest):
+        gcs_hook.upload(
+            self.gcs_bucket,
+            self.manifest_gcs_filepath,
+            data=json_codec.dumps(manifest),
+            mime_type="application/json; charset=utf-8"
+        )
 
 
 class IterableCatalogAPIToGoogleCloudStorage(BaseOperator):
+    """
+    Exports the items of all Iterable catalogs page by page.
 
-    template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath']
+    Pages are written to the output file as soon as they are fetched, with
+    max_concurrency > 1 several catalogs are fetched at the same time (items
+    of different catalogs are then interleaved in the output).
+
+    With max_shard_bytes or max_shard_records the output is split into
+    several objects, see IterableExportAPIToGoogleCloudStorage.
+    """
+
+    template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath', 'shard_manifest_filepath']
 
     def __init__(
             self,
@@ -213,150 +364,519 @@ class IterableCatalogAPIToGoogleCloudStorage(BaseOperator):
             gcp_conn_id='google_cloud_default',
             gcs_bucket=None,
             gcs_filepath=None,
+            page_size=1000,
+            max_concurrency=1, # number of catalogs fetched in parallel
+            staging='stream', # "stream" uploads while writing, "local" stages the output in a temporary file
+            compression=None, # None or "gzip", compresses the output on the fly
+            compression_level=6, # 1 (fastest) to 9 (smallest)
+            max_shard_bytes=None, # start a new output object after this many (uncompressed) bytes
+            max_shard_records=None, # start a new output object after this many records
+            shard_uploads=2, # finished shards uploaded in parallel
+            shard_manifest_filepath=None, # object in gcs_bucket receiving the shard manifest
             *args, **kwargs):
         super(IterableCatalogAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
         self.itr_conn_id = itr_conn_id
         self.gcp_conn_id = gcp_conn_id
         self.gcs_bucket = gcs_bucket
         self.gcs_filepath = gcs_filepath
-
+        self.staging = staging
+        self.compression = compression
+        self.compression_level = compression_level
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_records = max_shard_records
+        self.shard_uploads = shard_uploads
+        self.shard_manifest_filepath = shard_manifest_filepath
+        self.page_size = page_size
+        self.max_concurrency = max_concurrency
+
+    @report_request_metrics
     def execute(self, context):
-        # initialize hooks to Iterable and GCS
-        iterable_api_hook = IterableAPIHook(
-            itr_conn_id=self.itr_conn_id
+        # initialize hooks to Iterable (one per worker thread) and GCS
+        iterable_api_hooks = ThreadLocalHook(
+            lambda: IterableAPIHook(itr_conn_id=self.itr_conn_id)
         )
         gcs_hook = GCSHook(
             gcp_conn_id=self.gcp_conn_id
         )
         
         # fetch JSON catalog data from API 
-        # FIXME: we should iterate over pages, fix this long term! 
-        data_r = iterable_api_hook.catalogs()
-        catalog_names = json.loads(data_r.text)["params"]["catalogNames"]
-
-        # fetch JSON email template data from API 
-        records = []
-        for catalog_name in catalog_names:
-            # FIXME: we should iterate over pages, fix this long term! 
-            data_r = iterable_api_hook.catalog_items(catalog_name["name"])
-            catalog_items = json.loads(data_r.text)["params"]["catalogItemsWithProperties"]
-            for catalog_item in catalog_items:
-                record = {
-                    "catalogName": catalog_item["catalogName"],
-                    "itemId": catalog_item["itemId"],
-                    "size": catalog_item["size"],
-                    "lastModified": catalog_item["lastModified"],
-                    "value": json.dumps(catalog_item["value"]) # JSON type field with variable schema per item
-                }
-                records.append(record)
-
-        # convert records array to newline delimited json and upload to gcs
-        with NamedTemporaryFile("w") as f:
-            for record in records:
-                json.dump(record, f)
-                f.write('\n')
-            f.flush()
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=f.name, mime_type="application/json; charset=utf-8")
-
-
-class IterablePurchaseAPIToGoogleCloudStorage(BaseOperator):
-
-    template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath', 'start_date_time', 'end_date_time']
+        catalog_names = [
+            catalog_name["name"]
+            for catalog_names_page in iterable_api_hooks.get().iter_catalogs(page_size=self.page_size)
+            for catalog_name in catalog_names_page
+        ]
+
+        # fetch JSON catalog item data from API, one page at a time
+        def fetch_catalog_item_pages(catalog_name):
+            for catalog_items in iterable_api_hooks.get().iter_catalog_items(catalog_name, page_size=self.page_size):
+                yield [
+                    {
+                        "catalogName": catalog_item["catalogName"],
+                        "itemId": catalog_item["itemId"],
+                        "size": catalog_item["size"],
+                        "lastModified": catalog_item["lastModified"],
+                        "value": json_codec.dumps_str(catalog_item["value"]) # JSON type field with variable schema per item
+                    }
+                    for catalog_item in catalog_items
+                ]
+
+        # stream pages as newline delimited json to file and upload to gcs
+        with _open_json_output(gcs_hook, self.gcs_bucket, self.gcs_filepath, self.max_shard_bytes, self.max_shard_records,
+                self.shard_uploads, staging=self.staging,
+                compression=self.compression, compression_level=self.compression_level) as f:
+            for records in interleave(fetch_catalog_item_pages, catalog_names, self.max_concurrency):
+                f.write(json_codec.dump_lines(records))
+
+        if self.max_shard_bytes or self.max_shard_records:
+            _publish_shard_manifest(context, gcs_hook, self.gcs_bucket, self.shard_manifest_filepath, f.manifest())
+
+
+class IterableExportAPIToGoogleCloudStorage(BaseOperator):
+    """
+    Base operator streaming an Iterable data export (export/data.json) to GCS.
+
+    The export is streamed: lines are read, transformed (see
+    transform_record) and written to the output file in batches of
+    transform_batch_size lines, memory is bounded by one batch (with
+    parallel_transform by 2 * transform_processes batches) plus buffer_size
+    bytes of the response.
+
+    With windows > 1 the [start_date_time, end_date_time) range is split
+    into equally sized windows, parallel_windows of them are exported
+    concurrently. Every window is uploaded as its own object, these are then
+    composed into gcs_filepath or, with split_windows=True, kept as one
+    object per window (named gcs_filepath with the window index inserted
+    before the extension).
+
+    With checkpoint=True the completed windows are recorded in
+    gcs_filepath + ".checkpoint.json", a retry of the same task instance
+    only exports the windows which are still missing. Checkpoints need
+    windows > 1, a single window is always exported again.
+
+    With passthrough=True the response bytes are written to the output file
+    as they are (no transform_record), validate_every=n then only parses
+    every n-th line to check that the export is valid newline delimited json.
+
+    With output_format="parquet" the records are written as parquet row
+    groups of row_group_size records (requires pyarrow), see
+    ParquetRecordWriter for the schema inference. compression then selects
+    the parquet codec (default snappy) and windows need split_windows=True.
+
+    With parallel_transform=True lines are parsed, transformed and serialized
+    in batches of transform_batch_size lines on a pool of transform_processes
+    worker processes (default: number of cores), the record order is kept.
+
+    With max_shard_bytes or max_shard_records set, json output is split
+    into several objects (shards) while it is written, finished shards are
+    uploaded by shard_uploads background threads. Shards are named by
+    gcs_filepath used as str.format template with a {shard} field (e.g.
+    "users/{shard:05d}.json"), or gcs_filepath with "-{shard:05d}" inserted
+    before the extension. The shard URIs and a wildcard URI for BigQuery
+    loads are pushed to XCom (key "shards") and, with
+    shard_manifest_filepath, uploaded as json. Sharding excludes windows > 1.
+
+    With deferrable=True the export is deferred to the triggerer (see
+    IterableExportTrigger), the task only occupies a worker slot to start
+    the export and to compose the windows. Deferred exports write json
+    only and do not support parallel_transform, validate_every, sharding
+    or checkpoints (a retry exports all windows again). transform_record
+    overrides must be importable by the triggerer, i.e. defined on a
+    module level class.
+    """
+
+    template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath', 'start_date_time', 'end_date_time',
+        'shard_manifest_filepath']
+
+    # Iterable dataTypeName of the export
+    data_type_name = None
 
     def __init__(
             self,
-            start_date_time, # Accepts yyyy-MM-dd HH:mm:ss
-            end_date_time, # Accepts yyyy-MM-dd HH:mm:ss
             gcs_bucket,
             gcs_filepath,
+            start_date_time=None, # Accepts yyyy-MM-dd HH:mm:ss
+            end_date_time=None, # Accepts yyyy-MM-dd HH:mm:ss
+            only_fields=None,
             itr_conn_id='iterable_api_default', 
             gcp_conn_id='google_cloud_default',
+            buffer_size=102400, # bytes buffered when reading the response and writing the file
+            parallel_windows=1, # number of time windows exported in parallel
+            windows=None, # number of time windows (default parallel_windows)
+            split_windows=False, # keep one output object per window instead of composing them
+            checkpoint=True, # resume retries from the completed windows
+            passthrough=False, # write the raw response bytes without parsing them
+            validate_every=None, # parse every n-th line in passthrough mode (default none)
+            output_format='json', # "json" (newline delimited) or "parquet"
+            row_group_size=100000, # records per parquet row group
+            parallel_transform=False, # transform lines on a process pool
+            transform_processes=None, # worker processes (default number of cores)
+            transform_batch_size=10000, # lines per transform batch
+            staging='stream', # "stream" uploads while writing, "local" stages the output in a temporary file
+            compression=None, # None or "gzip", compresses the output on the fly
+            compression_level=6, # 1 (fastest) to 9 (smallest)
+            max_shard_bytes=None, # start a new output object after this many (uncompressed) bytes
+            max_shard_records=None, # start a new output object after this many records
+            shard_uploads=2, # finished shards uploaded in parallel
+            shard_manifest_filepath=None, # object in gcs_bucket receiving the shard manifest
+            deferrable=False, # run the export in the triggerer instead of a worker slot
             *args, **kwargs):
-        super(IterablePurchaseAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
+        super(IterableExportAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
         self.itr_conn_id = itr_conn_id
         self.gcp_conn_id = gcp_conn_id
         self.gcs_bucket = gcs_bucket
         self.gcs_filepath = gcs_filepath
+        self.staging = staging
+        self.compression = compression
+        self.compression_level = compression_level
         self.start_date_time = start_date_time
         self.end_date_time = end_date_time
-
+        self.only_fields = only_fields
+        self.buffer_size = buffer_size
+        self.parallel_windows = parallel_windows
+        self.windows = windows or parallel_windows
+        self.split_windows = split_windows
+        self.checkpoint = checkpoint
+        self.passthrough = passthrough
+        self.validate_every = validate_every
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        self.parallel_transform = parallel_transform
+        self.transform_processes = transform_processes
+        self.transform_batch_size = transform_batch_size
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_records = max_shard_records
+        self.shard_uploads = shard_uploads
+        self.shard_manifest_filepath = shard_manifest_filepath
+        self.deferrable = deferrable
+
+    @staticmethod
+    def transform_record(record):
+        """
+        Transforms an exported record before it is written, override in
+        subclasses. Must not depend on the operator instance, as it is sent
+        to worker processes with parallel_transform.
+        """
+
+        return record
+
+    @report_request_metrics
     def execute(self, context):
-        # initialize hooks to Iterable and GCS
-        iterable_api_hook = IterableAPIHook(
-            itr_conn_id=self.itr_conn_id
+        if self.passthrough and type(self).transform_record is not IterableExportAPIToGoogleCloudStorage.transform_record:
+            raise AirflowFailException(f"{type(self).__name__} transforms records and does not support passthrough")
+
+        if self.output_format not in ("json", "parquet"):
+            raise AirflowFailException(f"Unsupported output format {self.output_format}")
+
+        if self.output_format == "parquet" and self.passthrough:
+            raise AirflowFailException("passthrough is only supported for json output")
+
+        if self.output_format == "parquet" and self.windows > 1 and not self.split_windows:
+            raise AirflowFailException("parquet windows cannot be composed, set split_windows=True")
+
+        sharded = bool(self.max_shard_bytes or self.max_shard_records)
+        if sharded and (self.output_format != "json" or self.windows > 1):
+            raise AirflowFailException("sharding is only supported for json output without windows")
+
+        if self.deferrable:
+            self._defer_export(sharded)
+
+        # initialize hooks to Iterable (one per worker thread) and GCS
+        iterable_api_hooks = ThreadLocalHook(
+            lambda: IterableAPIHook(itr_conn_id=self.itr_conn_id)
         )
         gcs_hook = GCSHook(
             gcp_conn_id=self.gcp_conn_id
         )
-        
+
+        if self.windows <= 1:
+            if self.checkpoint:
+                log.warning("checkpoint requires windows > 1, a retry exports gs://%s/%s again in full", self.gcs_bucket, self.gcs_filepath)
+            f = self._export_window(iterable_api_hooks.get(), gcs_hook, self.start_date_time, self.end_date_time, self.gcs_filepath)
+            if sharded:
+                _publish_shard_manifest(context, gcs_hook, self.gcs_bucket, self.shard_manifest_filepath, f.manifest())
+            return
+
+        if not self.start_date_time or not self.end_date_time:
+            raise AirflowFailException("windows requires start_date_time and end_date_time")
+
+        windows = IterableAPIHook.split_export_range(self.start_date_time, self.end_date_time, self.windows)
+        object_names = self._window_object_names(len(windows))
+
+        # resume from the windows completed by previous tries of this task instance
+        checkpoint = self._checkpoint_state(context, windows)
+        completed = self._load_checkpoint(gcs_hook, checkpoint, object_names) if self.checkpoint else set()
+        checkpoint_lock = threading.Lock()
+        if completed:
+            log.info("Resuming export, %s of %s windows already completed", len(completed), len(windows))
+
+        def export_window(index):
+            if index in completed:
+                return
+
+            start_date_time, end_date_time = windows[index]
+            self._export_window(iterable_api_hooks.get(), gcs_hook, start_date_time, end_date_time, object_names[index])
+
+            if self.checkpoint:
+                with checkpoint_lock:
+                    completed.add(index)
+                    self._save_checkpoint(gcs_hook, dict(checkpoint, completed=sorted(completed)))
+
+        for _ in ordered_map(export_window, range(len(windows)), self.parallel_windows):
+            pass
+
+        if not self.split_windows:
+            self._compose(gcs_hook, object_names)
+
+        if self.checkpoint:
+            gcs_hook.delete(self.gcs_bucket, self._checkpoint_filepath())
+
+    def _defer_export(self, sharded):
+        if self.output_format != "json" or sharded or self.parallel_transform or self.validate_every:
+            raise AirflowFailException(
+                "deferrable exports support json output without sharding, parallel_transform and validate_every")
+
+        transform = type(self).transform_record
+        if self.passthrough or transform is IterableExportAPIToGoogleCloudStorage.transform_record:
+            transform_path = None
+        elif "<locals>" in transform.__qualname__:
+            raise AirflowFailException(f"{transform.__qualname__} cannot be imported by the triggerer")
+        else:
+            transform_path = f"{transform.__module__}:{transform.__qualname__}"
+
+        if self.windows <= 1:
+            windows = [(self.start_date_time, self.end_date_time)]
+            object_names = [compressed_object_name(self.gcs_filepath, self.compression)]
+        elif not self.start_date_time or not self.end_date_time:
+            raise AirflowFailException("windows requires start_date_time and end_date_time")
+        else:
+            windows = IterableAPIHook.split_export_range(self.start_date_time, self.end_date_time, self.windows)
+            object_names = self._window_object_names(len(windows))
+
+        # raises TaskDeferred, the task continues in execute_complete
+        self.defer(
+            trigger=IterableExportTrigger(
+                itr_conn_id=self.itr_conn_id,
+                gcp_conn_id=self.gcp_conn_id,
+                data_type_name=self.data_type_name,
+                only_fields=self.only_fields,
+                gcs_bucket=self.gcs_bucket,
+                windows=[[start, end, object_name] for (start, end), object_name in zip(windows, object_names)],
+                parallel_windows=self.parallel_windows,
+                transform=transform_path,
+                transform_batch_size=self.transform_batch_size,
+                buffer_size=self.buffer_size,
+                compression=self.compression,
+                compression_level=self.compression_level,
+            ),
+            method_name="execute_complete",
+        )
+
+    def execute_complete(self, context, event=None):
+        """Resumes a deferred export on the worker once the trigger finished."""
+
+        if event["status"] != "success":
+            # not AirflowFailException, the task retries export the data again
+            raise AirflowException(f"Deferred export failed: {event['message']}")
+
+        records = f", {event['records']} records" if event["records"] is not None else ""
+        log.info("Exported %s bytes%s into %s objects", event["bytes"], records, len(event["objects"]))
+
+        if self.windows > 1 and not self.split_windows:
+            self._compose(GCSHook(gcp_conn_id=self.gcp_conn_id), event["objects"])
+
+    def _window_object_names(self, count):
+        return [
+            compressed_object_name(
+                self._window_filepath(index) if self.split_windows else f"{self.gcs_filepath}.parts/{index:05d}",
+                self._stream_compression())
+            for index in range(count)
+        ]
+
+    def _export_window(self, iterable_api_hook, gcs_hook, start_date_time, end_date_time, object_name):
+        log.info("Exporting %s from %s to %s into gs://%s/%s", self.data_type_name, start_date_time, end_date_time, self.gcs_bucket, object_name)
+
         data_r = iterable_api_hook.export_data_json(
-            data_type_name='purchase',
-            start_date_time=self.start_date_time,
-            end_date_time=self.end_date_time,
+            data_type_name=self.data_type_name,
+            start_date_time=start_date_time,
+            end_date_time=end_date_time,
+            only_fields=self.only_fields,
             check_http_error=True
         )
 
-        records = []
-        for row_str in data_r.text.splitlines():
-            row = json.loads(row_str)
-            row['userId'] = hashlib.sha256(row['email'].encode('utf-8').strip().lower()).hexdigest().lower()
+        if self.output_format == "parquet":
+            # stream records as parquet row groups to gcs
+            with data_r, open_gcs_sink(gcs_hook, self.gcs_bucket, object_name, mime_type=PARQUET_MIME_TYPE, text=False,
+                    staging=self.staging, buffer_size=self.buffer_size) as f:
+                parquet_writer = ParquetRecordWriter(f, row_group_size=self.row_group_size, compression=self.compression or "snappy")
+                for records in self._iter_record_batches(data_r, serialize=False):
+                    for record in records:
+                        parquet_writer.write(record)
+                parquet_writer.close()
+            return
+
+        # stream records as newline delimited json to file(s) and upload to gcs
+        with data_r, _open_json_output(gcs_hook, self.gcs_bucket, object_name, self.max_shard_bytes, self.max_shard_records,
+                self.shard_uploads, staging=self.staging, buffer_size=self.buffer_size,
+                compression=self.compression, compression_level=self.compression_level) as f:
+            if self.passthrough:
+                self._write_passthrough(data_r, f)
+            else:
+                for records_bytes in self._iter_record_batches(data_r, serialize=True):
+                    f.write(records_bytes)
+
+        # the sharded sink lists the written shards
+        return f
+
+    def _iter_record_batches(self, data_r, serialize):
+        lines = data_r.iter_lines(self.buffer_size)
+        transform_batch = partial(transform_lines, type(self).transform_record, serialize=serialize)
+
+        if not self.parallel_transform:
+            for batch in batched(lines, self.transform_batch_size):
+                yield transform_batch(batch)
+            return
+
+        yield from ordered_map(transform_batch, batched(lines, self.transform_batch_size),
+            self.transform_processes or os.cpu_count(), processes=True)
+
+    def _stream_compression(self):
+        # parquet compresses its column chunks itself
+        return None if self.output_format == "parquet" else self.compression
+
+    def _write_passthrough(self, data_r, f):
+        # the export already is newline delimited json, copy it without a decode/encode round trip
+        if not self.validate_every:
+            for chunk in data_r.iter_content(self.buffer_size):
+                f.write(chunk)
+            return
+
+        for line_number, record_bytes in enumerate(data_r.iter_lines(self.buffer_size)):
+            if not record_bytes:
+                continue
+
+            if line_number % self.validate_every == 0:
+                json_codec.loads(record_bytes)
+
+            f.write(record_bytes)
+            f.write(b'\n')
+
+    def _checkpoint_filepath(self):
+        return f"{self.gcs_filepath}.checkpoint.json"
+
+    def _checkpoint_state(self, context, windows):
+        # a checkpoint is only valid for the same task instance and export layout
+        ti = context["ti"]
+        return {
+            "dag_id": ti.dag_id,
+            "task_id": ti.task_id,
+            "run_id": ti.run_id,
+            "map_index": ti.map_index,
+            "data_type_name": self.data_type_name,
+            "only_fields": list(self.only_fields) if isinstance(self.only_fields, (list, tuple)) else self.only_fields,
+            "split_windows": self.split_windows,
+            "compression": self.compression,
+            "output_format": self.output_format,
+            "windows": [list(window) for window in windows],
+        }
+
+    def _load_checkpoint(self, gcs_hook, checkpoint, object_names):
+        checkpoint_filepath = self._checkpoint_filepath()
+        if not gcs_hook.exists(self.gcs_bucket, checkpoint_filepath):
+            return set()
+
+        saved_checkpoint = json_codec.loads(gcs_hook.download(self.gcs_bucket, checkpoint_filepath))
+        completed = saved_checkpoint.pop("completed", [])
+        if saved_checkpoint != checkpoint:
+            log.info("Ignoring checkpoint gs://%s/%s of a different task instance or export", self.gcs_bucket, checkpoint_filepath)
+            return set()
+
+        # uploads are atomic, a window is complete as long as its object still exists
+        return {index for index in completed if gcs_hook.exists(self.gcs_bucket, object_names[index])}
+
+    def _save_checkpoint(self, gcs_hook, checkpoint):
+        gcs_hook.upload(
+            self.gcs_bucket,
+            self._checkpoint_filepath(),
+            data=json_codec.dumps(checkpoint),
+            mime_type="application/json; charset=utf-8"
+        )
 
-            records.append(row)
+    def _window_filepath(self, index):
+        path, dot, extension = self.gcs_filepath.rpartition(".")
+        if not dot or "/" in extension:
+            return f"{self.gcs_filepath}-{index:05d}"
+        return f"{path}-{index:05d}.{extension}"
 
-        # convert records array to newline delimited json and upload to gcs
-        with NamedTemporaryFile("w") as f:
-            for record in records:
-                json.dump(record, f)
-                f.write('\n')
-            f.flush()
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=f.name, mime_type="application/json; charset=utf-8")
+    def _compose(self, gcs_hook, object_names):
+        bucket = gcs_hook.get_conn().bucket(self.gcs_bucket)
 
+        destination = bucket.blob(compressed_object_name(self.gcs_filepath, self._stream_compression()))
+        destination.content_type = "application/json; charset=utf-8"
+        if self.compression:
+            # concatenated gzip members are a valid gzip stream
+            destination.content_encoding = COMPRESSIONS[self.compression][0]
 
-class IterableUserAPIToGoogleCloudStorage(BaseOperator):
+        # GCS composes at most 32 objects per request, append the rest to the intermediate result
+        sources = [bucket.blob(object_name) for object_name in object_names]
+        destination.compose(sources[:32])
+        for i in range(32, len(sources), 31):
+            destination.compose([destination] + sources[i:i + 31])
+
+        for source in sources:
+            source.delete()
 
-    template_fields = ['itr_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath']
+
+class IterablePurchaseAPIToGoogleCloudStorage(IterableExportAPIToGoogleCloudStorage):
+    """
+    Exports Iterable purchases and adds the hashed email as userId.
+    """
+
+    data_type_name = 'purchase'
 
     def __init__(
             self,
-            fields,
+            start_date_time, # Accepts yyyy-MM-dd HH:mm:ss
+            end_date_time, # Accepts yyyy-MM-dd HH:mm:ss
             gcs_bucket,
             gcs_filepath,
-            itr_conn_id='iterable_api_default',
+            itr_conn_id='iterable_api_default', 
             gcp_conn_id='google_cloud_default',
             *args, **kwargs):
-        super(IterableUserAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
-        self.itr_conn_id = itr_conn_id
-        self.gcp_conn_id = gcp_conn_id
-        self.gcs_bucket = gcs_bucket
-        self.gcs_filepath = gcs_filepath
-        self.fields = fields
+        super(IterablePurchaseAPIToGoogleCloudStorage, self).__init__(
+            gcs_bucket=gcs_bucket,
+            gcs_filepath=gcs_filepath,
+            start_date_time=start_date_time,
+            end_date_time=end_date_time,
+            itr_conn_id=itr_conn_id,
+            gcp_conn_id=gcp_conn_id,
+            *args, **kwargs)
+
+    transform_record = staticmethod(add_hashed_user_id)
 
-    def execute(self, context):
-        # initialize hooks to Iterable and GCS
-        iterable_api_hook = IterableAPIHook(
-            itr_conn_id=self.itr_conn_id
-        )
-        gcs_hook = GCSHook(
-            gcp_conn_id=self.gcp_conn_id
-        )
-        
-        data_r = iterable_api_hook.export_data_json(
-            data_type_name="user",
-            only_fields=self.fields,
-            check_http_error=True
-        )
 
-        # convert records array to newline delimited json (with buffer of 100kb to avoid OOM) and upload to gcs
-        with NamedTemporaryFile("w", buffering=102400) as f:
-            # read lines to temporary file
-            for record_str in data_r.iter_lines(1000):
-                # read json record from response
-                record = json.loads(record_str)
+class IterableUserAPIToGoogleCloudStorage(IterableExportAPIToGoogleCloudStorage):
+    """
+    Exports the selected fields of all Iterable users.
 
-                # write newline-json record directly to file
-                json.dump(record, f)
-                f.write('\n')
-            f.flush()
+    start_date_time and end_date_time optionally restrict the export to
+    users updated within that range (required for windows).
+    """
 
-            # upload file to gcs
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=f.name, mime_type="application/json; charset=utf-8")
+    data_type_name = 'user'
+
+    def __init__(
+            self,
+            fields,
+            gcs_bucket,
+            gcs_filepath,
+            itr_conn_id='iterable_api_default',
+            gcp_conn_id='google_cloud_default',
+            *args, **kwargs):
+        super(IterableUserAPIToGoogleCloudStorage, self).__init__(
+            gcs_bucket=gcs_bucket,
+            gcs_filepath=gcs_filepath,
+            only_fields=fields,
+            itr_conn_id=itr_conn_id,
+            gcp_conn_id=gcp_conn_id,
+            *args, **kwargs)
+        self.fields = fields
@@ -0,0 +1,472 @@
+"""
+
+Iterable bulk API operators
+
+Batched, concurrent variants of the Iterable bulk endpoints, reading their
+input from a list or a newline delimited json object in GCS.
+
+"""
+
+import hashlib
+import logging
+
+import tenacity
+from airflow.exceptions import AirflowException, AirflowFailException
+from airflow.models import BaseOperator
+from airflow.providers.google.cloud.hooks.gcs import GCSHook
+
+from hooks import json_codec, request_metrics
+from hooks.iterable_api_hook import IterableAPIHook
+from hooks.request_metrics import report_request_metrics
+from operators.concurrent_fetch import ThreadLocalHook, ordered_map
+from operators.gcs_sink import open_gcs_sink
+from operators.record_pipeline import batched
+
+log = logging.getLogger(__name__)
+
+
+def iter_gcs_ndjson(gcs_hook, bucket_name, object_name, chunk_size=8 * 1024 * 1024):
+    """Streams the records of a newline delimited json object in GCS."""
+
+    blob = gcs_hook.get_conn().bucket(bucket_name).blob(object_name)
+    with blob.open("rb", chunk_size=chunk_size) as f:
+        for line in f:
+            if line.strip():
+                yield json_codec.loads(line)
+
+
+def iter_gcs_emails(gcs_hook, bucket_name, object_name):
+    """Streams the emails of a GCS object, one email (or json object with an email field) per line."""
+
+    blob = gcs_hook.get_conn().bucket(bucket_name).blob(object_name)
+    with blob.open("rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield json_codec.loads(line)["email"] if line.startswith(b"{") else line.decode("utf-8")
+
+
+def merge_bulk_response(summary, response, max_reported=10000):
+    """
+    Merges an Iterable bulk response into a summary: counts are summed,
+    email/id lists are concatenated (up to max_reported entries each) and
+    nested objects (e.g. failedUpdates) are merged the same way.
+    """
+
+    for key, value in response.items():
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, (int, float)):
+            summary[key] = summary.get(key, 0) + value
+        elif isinstance(value, list):
+            reported = summary.setdefault(key, [])
+            if len(reported) + len(value) > max_reported:
+                summary["truncated"] = True
+            reported.extend(value[:max(0, max_reported - len(reported))])
+        elif isinstance(value, dict):
+            merge_bulk_response(summary.setdefault(key, {}), value, max_reported)
+
+    return summary
+
+
+def bulk_update_users(itr_conn_id, users, batch_size=1000, max_concurrency=1, max_reported=10000):
+    """
+    Sends users to https://api.iterable.com/api/docs#users_bulkUpdateUsers in
+    batches of batch_size, max_concurrency batches at a time (rate limited by
+    the hook).
+
+    A batch failing after all retries does not stop the others, it is
+    reported in failedBatches instead.
+
+    :param users: user update objects (email/userId, dataFields, ...), may be a generator
+    :type users: iterable
+    :return: merged summary of all bulk responses
+    """
+
+    iterable_api_hooks = ThreadLocalHook(
+        lambda: IterableAPIHook(itr_conn_id=itr_conn_id)
+    )
+
+    def send_batch(batch):
+        try:
+            response = iterable_api_hooks.get().bulk_update_users({"users": batch}, check_http_error=True)
+            return len(batch), json_codec.loads(response.content), None
+        except Exception as e:
+            log.exception("Bulk update of %s users failed", len(batch))
+            first_user = batch[0].get("email") or batch[0].get("userId")
+            return len(batch), None, {"size": len(batch), "firstUser": first_user, "error": str(e)}
+
+    summary = {"batches": 0, "users": 0, "failedBatches": []}
+    for batch_size_sent, response, error in ordered_map(send_batch, batched(users, batch_size), max_concurrency):
+        summary["batches"] += 1
+        summary["users"] += batch_size_sent
+        if error is not None:
+            summary["failedBatches"].append(error)
+        else:
+            merge_bulk_response(summary, response, max_reported)
+
+    return summary
+
+
+class IterableBulkUpdateUsersOperator(BaseOperator):
+    """
+    Updates Iterable users from a list or a newline delimited json object in
+    GCS (one user update object per line), see bulk_update_users.
+
+    The summary (success/fail counts, invalid and failed emails, failed
+    batches) is returned through XCom. The task fails after all batches
+    were sent if any batch failed.
+    """
+
+    template_fields = ['itr_conn_id', 'gcp_conn_id', 'users', 'gcs_bucket', 'gcs_filepath']
+
+    def __init__(
+            self,
+            users=None,
+            gcs_bucket=None,
+            gcs_filepath=None,
+            itr_conn_id='iterable_api_default',
+            gcp_conn_id='google_cloud_default',
+            batch_size=1000, # users per bulkUpdate request
+            max_concurrency=1, # number of parallel requests
+            max_reported=10000, # max emails/ids reported per list in the summary
+            *args, **kwargs):
+        super(IterableBulkUpdateUsersOperator, self).__init__(*args, **kwargs)
+        self.users = users
+        self.gcs_bucket = gcs_bucket
+        self.gcs_filepath = gcs_filepath
+        self.itr_conn_id = itr_conn_id
+        self.gcp_conn_id = gcp_conn_id
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_reported = max_reported
+
+    @report_request_metrics
+    def execute(self, context):
+        if self.users is not None:
+            users = self.users
+        elif self.gcs_bucket and self.gcs_filepath:
+            users = iter_gcs_ndjson(GCSHook(gcp_conn_id=self.gcp_conn_id), self.gcs_bucket, self.gcs_filepath)
+        else:
+            raise AirflowFailException("Either users or gcs_bucket and gcs_filepath are required")
+
+        summary = bulk_update_users(
+            self.itr_conn_id,
+            users,
+            batch_size=self.batch_size,
+            max_concurrency=self.max_concurrency,
+            max_reported=self.max_reported
+        )
+        log.info("Bulk updated %s users in %s batches: %s succeeded, %s failed, %s failed batches",
+            summary["users"], summary["batches"], summary.get("successCount", 0), summary.get("failCount", 0),
+            len(summary["failedBatches"]))
+
+        if summary["failedBatches"]:
+            context["ti"].xcom_push(key="return_value", value=summary)
+            raise AirflowFailException(f"{len(summary['failedBatches'])} bulk update batches failed")
+
+        return summary
+
+
+class IterableDeleteUsersOperator(BaseOperator):
+    """
+    Deletes Iterable users (e.g. for GDPR requests) by email, see
+    https://api.iterable.com/api/docs#users_delete
+
+    Emails are read from a list or a GCS object (one email, or json object
+    with an email field, per line) and deleted max_concurrency at a time,
+    rate limited by the hook. 429 and 5xx responses are retried with the
+    retry policy of the hook before a deletion counts as failed.
+
+    Every checkpoint_every emails the results are saved next to the
+    manifest, a retry of the same task instance skips the emails already
+    deleted (or not found). At the end a manifest with one result per email
+    ({"email", "status": deleted/not_found/failed, "httpStatus", "code",
+    "message"}) is written to manifest_gcs_filepath and the counts are
+    returned through XCom. The task fails (and is retried if it has
+    retries) if any deletion failed, a retry only repeats those.
+    """
+
+    template_fields = ['itr_conn_id', 'gcp_conn_id', 'emails', 'gcs_bucket', 'gcs_filepath', 'manifest_gcs_bucket', 'manifest_gcs_filepath']
+
+    def __init__(
+            self,
+            manifest_gcs_bucket,
+            manifest_gcs_filepath,
+            emails=None,
+            gcs_bucket=None,
+            gcs_filepath=None,
+            itr_conn_id='iterable_api_default',
+            gcp_conn_id='google_cloud_default',
+            max_concurrency=1, # number of parallel delete requests
+            checkpoint_every=1000, # emails per saved checkpoint
+            *args, **kwargs):
+        super(IterableDeleteUsersOperator, self).__init__(*args, **kwargs)
+        self.manifest_gcs_bucket = manifest_gcs_bucket
+        self.manifest_gcs_filepath = manifest_gcs_filepath
+        self.emails = emails
+        self.gcs_bucket = gcs_bucket
+        self.gcs_filepath = gcs_filepath
+        self.itr_conn_id = itr_conn_id
+        self.gcp_conn_id = gcp_conn_id
+        self.max_concurrency = max_concurrency
+        self.checkpoint_every = checkpoint_every
+
+    @report_request_metrics
+    def execute(self, context):
+        gcs_hook = GCSHook(
+            gcp_conn_id=self.gcp_conn_id
+        )
+        iterable_api_hooks = ThreadLocalHook(
+            lambda: IterableAPIHook(itr_conn_id=self.itr_conn_id)
+        )
+
+        if self.emails is not None:
+            emails = self.emails
+        elif self.gcs_bucket and self.gcs_filepath:
+            emails = iter_gcs_emails(gcs_hook, self.gcs_bucket, self.gcs_filepath)
+        else:
+            raise AirflowFailException("Either emails or gcs_bucket and gcs_filepath are required")
+
+        # results of previous tries of this task instance
+        checkpoint_prefix = self._checkpoint_prefix(context)
+        checkpoint_names = sorted(gcs_hook.list(self.manifest_gcs_bucket, prefix=checkpoint_prefix))
+        results = {}
+        for checkpoint_name in checkpoint_names:
+            for line in gcs_hook.download(self.manifest_gcs_bucket, checkpoint_name).splitlines():
+                result = json_codec.loads(line)
+                results[result["email"]] = result
+
+        done = {email for email, result in results.items() if result["status"] != "failed"}
+        if done:
+            log.info("Resuming deletion, skipping %s emails completed by previous tries", len(done))
+
+        def delete_user(email):
+            return self._delete_user(iterable_api_hooks.get(), email)
+
+        pending_emails = (email for email in _unique(emails) if email not in done)
+        new_results = []
+        for result in ordered_map(delete_user, pending_emails, self.max_concurrency):
+            results[result["email"]] = result
+            new_results.append(result)
+            if len(new_results) >= self.checkpoint_every:
+                checkpoint_names.append(self._save_checkpoint(gcs_hook, checkpoint_prefix, len(checkpoint_names), new_results))
+                new_results = []
+        if new_results:
+            checkpoint_names.append(self._save_checkpoint(gcs_hook, checkpoint_prefix, len(checkpoint_names), new_results))
+
+        # write the manifest of all emails
+        summary = {"emails": len(results), "deleted": 0, "not_found": 0, "failed": 0, "resumed": len(done)}
+        with open_gcs_sink(gcs_hook, self.manifest_gcs_bucket, self.manifest_gcs_filepath, text=False) as f:
+            for result in results.values():
+                summary[result["status"]] += 1
+                f.write(json_codec.dump_line(result))
+
+        log.info("Deleted %s users, %s not found, %s failed", summary["deleted"], summary["not_found"], summary["failed"])
+
+        if summary["failed"]:
+            # keep the checkpoints, a retry of the task only repeats the failed deletions
+            context["ti"].xcom_push(key="return_value", value=summary)
+            raise AirflowException(f"Deleting {summary['failed']} users failed, see gs://{self.manifest_gcs_bucket}/{self.manifest_gcs_filepath}")
+
+        for checkpoint_name in checkpoint_names:
+            gcs_hook.delete(self.manifest_gcs_bucket, checkpoint_name)
+
+        return summary
+
+    def _delete_user(self, iterable_api_hook, email):
+        # check_http_error=False keeps 404 (not found) from being retried,
+        # rate limited and server errors are retried here instead
+        def record_retry(retry_state):
+            request_metrics.record_retry(iterable_api_hook.api_conn_id, "users", retry_state.next_action.sleep)
+
+        retrying = tenacity.Retrying(
+            retry=tenacity.retry_if_result(_is_retried_response),
+            retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+            before_sleep=record_retry,
+            **iterable_api_hook.retry_args
+        )
+        try:
+            response = retrying(iterable_api_hook.users_delete, email, check_http_error=False)
+        except Exception as e:
+            log.exception("Deleting user failed")
+            return {"email": email, "status": "failed", "httpStatus": None, "code": None, "message": str(e)}
+
+        try:
+            body = json_codec.loads(response.content)
+        except ValueError:
+            body = {}
+
+        if response.ok:
+            status = "deleted"
+        elif response.status_code == 404 or "not found" in str(body.get("msg", "")).lower():
+            status = "not_found"
+        else:
+            status = "failed"
+
+        return {"email": email, "status": status, "httpStatus": response.status_code, "code": body.get("code"), "message": body.get("msg")}
+
+    def _checkpoint_prefix(self, context):
+        # checkpoints are only valid for the same task instance
+        ti = context["ti"]
+        task_instance_key = hashlib.sha1(f"{ti.dag_id}/{ti.task_id}/{ti.run_id}/{ti.map_index}".encode("utf-8")).hexdigest()[:16]
+        return f"{self.manifest_gcs_filepath}.checkpoints/{task_instance_key}/"
+
+    def _save_checkpoint(self, gcs_hook, checkpoint_prefix, index, results):
+        checkpoint_name = f"{checkpoint_prefix}{index:06d}"
+        gcs_hook.upload(
+            self.manifest_gcs_bucket,
+            checkpoint_name,
+            data=json_codec.dump_lines(results),
+            mime_type="application/json; charset=utf-8"
+        )
+        return checkpoint_name
+
+
+def _is_retried_response(response):
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def _unique(items):
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def bulk_subscription_action(itr_conn_id, subscriptions, users, batch_size=1000, max_concurrency=1, by_user_id=False, max_reported=10000):
+    """
+    Applies subscription actions with
+    https://api.iterable.com/api/docs#subscriptions_Bulk_subscription_action
+    in batches of batch_size users, max_concurrency batches at a time (rate
+    limited by the hook).
+
+    A batch failing after all retries does not stop the others, it is
+    reported in failedBatches of its subscription instead.
+
+    :param subscriptions: (subscription_group, subscription_group_id, action) tuples,
+        e.g. ("messageType", 123, "unsubscribe")
+    :type subscriptions: list
+    :param users: callable returning a new iterable of the user emails (or
+        userIds) on every call, it is iterated once per subscription
+    :type users: callable
+    :param by_user_id: users are userIds instead of emails
+    :type by_user_id: bool
+    :return: summary per subscription and totals
+    """
+
+    iterable_api_hooks = ThreadLocalHook(
+        lambda: IterableAPIHook(itr_conn_id=itr_conn_id)
+    )
+    users_key = "usersByUserId" if by_user_id else "users"
+
+    def work_items():
+        for index, subscription in enumerate(subscriptions):
+            for batch in batched(users(), batch_size):
+                yield index, subscription, batch
+
+    def send_batch(work_item):
+        index, (subscription_group, subscription_group_id, action), batch = work_item
+        try:
+            response = iterable_api_hooks.get().bulk_subscription_action(
+                subscription_group, subscription_group_id, action, {users_key: batch}, check_http_error=True)
+            return index, len(batch), json_codec.loads(response.content) if response.content else {}, None
+        except Exception as e:
+            log.exception("Bulk %s of %s users for %s %s failed", action, len(batch), subscription_group, subscription_group_id)
+            return index, len(batch), None, {"size": len(batch), "firstUser": batch[0], "error": str(e)}
+
+    summaries = [
+        {
+            "subscriptionGroup": subscription_group,
+            "subscriptionGroupId": subscription_group_id,
+            "action": action,
+            "batches": 0,
+            "users": 0,
+            "failedBatches": []
+        }
+        for subscription_group, subscription_group_id, action in subscriptions
+    ]
+    for index, batch_size_sent, response, error in ordered_map(send_batch, work_items(), max_concurrency):
+        summary = summaries[index]
+        summary["batches"] += 1
+        summary["users"] += batch_size_sent
+        if error is not None:
+            summary["failedBatches"].append(error)
+        else:
+            merge_bulk_response(summary, response, max_reported)
+
+    return {
+        "subscriptions": summaries,
+        "successCount": sum(summary.get("successCount", 0) for summary in summaries),
+        "failCount": sum(summary.get("failCount", 0) for summary in summaries),
+        "failedBatches": sum(len(summary["failedBatches"]) for summary in summaries),
+    }
+
+
+class IterableBulkSubscriptionActionOperator(BaseOperator):
+    """
+    Subscribes or unsubscribes users for a list of subscription groups, see
+    bulk_subscription_action.
+
+    Users (emails, or userIds with by_user_id=True) are read from a list or
+    a GCS object (one user, or json object with an email field, per line).
+    The aggregated success and failure counts are returned through XCom.
+    The task fails after all batches were sent if any batch failed.
+    """
+
+    template_fields = ['itr_conn_id', 'gcp_conn_id', 'subscriptions', 'users', 'gcs_bucket', 'gcs_filepath']
+
+    def __init__(
+            self,
+            subscriptions, # list of (subscription_group, subscription_group_id, action)
+            users=None,
+            gcs_bucket=None,
+            gcs_filepath=None,
+            by_user_id=False,
+            itr_conn_id='iterable_api_default',
+            gcp_conn_id='google_cloud_default',
+            batch_size=1000, # users per subscription request
+            max_concurrency=1, # number of parallel requests
+            max_reported=10000, # max emails/ids reported per list in the summary
+            *args, **kwargs):
+        super(IterableBulkSubscriptionActionOperator, self).__init__(*args, **kwargs)
+        self.subscriptions = subscriptions
+        self.users = users
+        self.gcs_bucket = gcs_bucket
+        self.gcs_filepath = gcs_filepath
+        self.by_user_id = by_user_id
+        self.itr_conn_id = itr_conn_id
+        self.gcp_conn_id = gcp_conn_id
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_reported = max_reported
+
+    @report_request_metrics
+    def execute(self, context):
+        if self.users is not None:
+            users = lambda: self.users
+        elif self.gcs_bucket and self.gcs_filepath:
+            gcs_hook = GCSHook(gcp_conn_id=self.gcp_conn_id)
+            users = lambda: iter_gcs_emails(gcs_hook, self.gcs_bucket, self.gcs_filepath)
+        else:
+            raise AirflowFailException("Either users or gcs_bucket and gcs_filepath are required")
+
+        summary = bulk_subscription_action(
+            self.itr_conn_id,
+            [tuple(subscription) for subscription in self.subscriptions],
+            users,
+            batch_size=self.batch_size,
+            max_concurrency=self.max_concurrency,
+            by_user_id=self.by_user_id,
+            max_reported=self.max_reported
+        )
+        log.info("Applied %s subscription actions: %s succeeded, %s failed, %s failed batches",
+            len(summary["subscriptions"]), summary["successCount"], summary["failCount"], summary["failedBatches"])
+
+        if summary["failedBatches"]:
+            context["ti"].xcom_push(key="return_value", value=summary)
+            raise AirflowFailException(f"{summary['failedBatches']} bulk subscription batches failed")
+
+        return summary
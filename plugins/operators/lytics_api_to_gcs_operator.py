@@ -4,24 +4,181 @@ Lytics API to Google Cloud Storage transfer operator
 
 """
 
-import json
 import uuid
 import logging
 from datetime import datetime
-from tempfile import NamedTemporaryFile
 
 from airflow.models import BaseOperator
 from airflow.providers.google.cloud.hooks.gcs import GCSHook
-from airflow.exceptions import AirflowFailException
+from airflow.exceptions import AirflowException, AirflowFailException
 
+from hooks import json_codec
 from hooks.lytics_api_hook import LyticsAPIHook
+from hooks.request_metrics import report_request_metrics
+from operators.concurrent_fetch import ThreadLocalHook, ordered_map
+from operators.gcs_sink import open_gcs_sink
+from operators.record_pipeline import batched
 
 log = logging.getLogger(__name__)
 
+# records serialized and written at a time
+WRITE_BATCH_SIZE = 1000
+
+# lytics_api_path -> handler, see register_lytics_api_path
+LYTICS_API_PATHS = {}
+
+
+def register_lytics_api_path(path):
+    """
+    Registers a handler of a Lytics API path for LyticsAPIToGoogleCloudStorage.
+
+    The handler is a generator function (operator, lytics_api_hook, context)
+    yielding the records of the path, they are written as they are yielded.
+
+        @register_lytics_api_path("/v2/segment")
+        def segments(operator, lytics_api_hook, context):
+            ...
+    """
+
+    def register(handler):
+        LYTICS_API_PATHS[path] = handler
+        return handler
+
+    return register
+
+
+@register_lytics_api_path("/v2/job")
+def _jobs(operator, lytics_api_hook, context):
+    get_v2_job_r = lytics_api_hook.get_v2_job(show_deleted=True, show_completed=True, check_http_error=True)
+    yield from json_codec.loads(get_v2_job_r.content)["data"]
+
+
+def new_log_entries(entries, watermark, watermark_field, watermark_id_field='id'):
+    """
+    Filters the log entries of a job by its watermark and advances it.
+
+    A watermark is {"value": highest watermark_field value exported, "ids":
+    watermark_id_field values of the entries with that value}, so entries
+    sharing the timestamp of the last exported entry are not lost. Entries
+    without watermark_field are always kept.
+
+    :param watermark: watermark of the previous export, None exports all entries
+    :type watermark: dict
+    :return: the new entries and the watermark after them
+    """
+
+    value = watermark["value"] if watermark else None
+    ids = set(watermark["ids"]) if watermark else set()
+
+    entries = [
+        entry for entry in entries
+        if value is None or entry.get(watermark_field) is None or entry[watermark_field] > value
+        or (entry[watermark_field] == value and entry.get(watermark_id_field) not in ids)
+    ]
+
+    for entry in entries:
+        entry_value = entry.get(watermark_field)
+        if entry_value is None:
+            continue
+        if value is None or entry_value > value:
+            value, ids = entry_value, set()
+        if entry_value == value and entry.get(watermark_id_field) is not None:
+            ids.add(entry[watermark_id_field])
+
+    if value is None:
+        return entries, watermark
+    return entries, {"value": value, "ids": sorted(ids, key=str)}
+
+
+@register_lytics_api_path("/v2/job/{id}/logs")
+def _job_logs(operator, lytics_api_hook, context):
+    get_v2_job_r = lytics_api_hook.get_v2_job(show_deleted=False, show_completed=False, check_http_error=True)
+    ids = [get_v2_job_data["id"] for get_v2_job_data in json_codec.loads(get_v2_job_r.content)["data"]]
+
+    # with watermarks only the log entries newer than the last export are written
+    watermarks = operator.load_watermarks() if operator.watermark_filepath else None
+
+    def fetch_job_logs(hook, id):
+        get_v2_job_logs_r = hook.get_v2_job_logs(id, check_http_error=True)
+        get_v2_job_logs_data = json_codec.loads(get_v2_job_logs_r.content)["data"]
+        if watermarks is None:
+            return id, get_v2_job_logs_data, None, 0
+        new_entries, watermark = new_log_entries(get_v2_job_logs_data, watermarks.get(id),
+            operator.watermark_field, operator.watermark_id_field)
+        return id, new_entries, watermark, len(get_v2_job_logs_data) - len(new_entries)
+
+    # watermarks of failed jobs are kept, those of jobs no longer listed are dropped
+    new_watermarks = {id: watermarks[id] for id in ids if id in watermarks} if watermarks is not None else None
+    skipped = 0
+    for id, get_v2_job_logs_data, watermark, skipped_entries in operator.fetch_each(fetch_job_logs, ids, context):
+        if watermark is not None:
+            new_watermarks[id] = watermark
+        skipped += skipped_entries
+        yield from get_v2_job_logs_data
+
+    if new_watermarks is not None:
+        log.info("Skipped %s log entries exported by previous runs", skipped)
+        operator.stage_watermarks(new_watermarks)
+
+
+@register_lytics_api_path("/api/ml")
+def _ml_models(operator, lytics_api_hook, context):
+    get_v1_ml_r = lytics_api_hook.get_v1_ml(check_http_error=True)
+    yield from json_codec.loads(get_v1_ml_r.content)["data"]
+
+
+@register_lytics_api_path("/api/ml/{id}/summary")
+def _ml_summaries(operator, lytics_api_hook, context):
+    get_v1_ml_r = lytics_api_hook.get_v1_ml(check_http_error=True)
+    ids = [get_v1_ml_data["id"] for get_v1_ml_data in json_codec.loads(get_v1_ml_r.content)["data"]]
+
+    def fetch_ml_summary(hook, id):
+        get_v1_ml_summary_r = hook.get_v1_ml_summary(id, check_http_error=True)
+        return json_codec.loads(get_v1_ml_summary_r.content)["data"]
+
+    yield from operator.fetch_each(fetch_ml_summary, ids, context)
+
+
+@register_lytics_api_path("/api/segment/sizes")
+def _segment_sizes(operator, lytics_api_hook, context):
+    if operator.properties is None:
+        raise AirflowFailException(f"Missing required properties for API path {operator.lytics_api_path}")
+
+    response = lytics_api_hook.get_v1_segment_sizes(operator.properties["audiences"])
+    yield from json_codec.loads(response.content)["data"] or []
+
+
+@register_lytics_api_path("/v2/stream")
+def _streams(operator, lytics_api_hook, context):
+    response = lytics_api_hook.get_v2_stream()
+    yield from json_codec.loads(response.content)["data"] or []
+
 
 class LyticsAPIToGoogleCloudStorage(BaseOperator):
+    """
+    Fetches a Lytics API path and writes its records as newline delimited
+    json to GCS, each wrapped as {"timestamp", "data"} with the time the
+    task started.
+
+    The records are written while they are fetched. The supported paths are
+    the handlers registered in LYTICS_API_PATHS (see register_lytics_api_path).
+
+    The per id paths ("/v2/job/{id}/logs", "/api/ml/{id}/summary") list the
+    jobs or models first and then fetch up to max_concurrency ids at a time,
+    the results are written in list order as they arrive. An id failing
+    after all retries is logged and skipped, the failed ids are pushed to
+    XCom (key "failed_ids"). The task fails (without replacing the output)
+    when more than max_failed_ids ids or all ids failed.
+
+    With watermark_filepath, "/v2/job/{id}/logs" is exported incrementally:
+    the highest watermark_field value (e.g. the log timestamp) exported per
+    job is kept in that object in gcs_bucket, and only newer log entries are
+    written (see new_log_entries). The watermarks are saved after the output
+    was uploaded, a failed run exports the same entries again. Runs sharing
+    watermark_filepath must not overlap (max_active_runs=1).
+    """
 
-    template_fields = ['lytics_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath']
+    template_fields = ['lytics_conn_id', 'gcp_conn_id', 'gcs_bucket', 'gcs_filepath', 'watermark_filepath']
 
     def __init__(
             self,
@@ -31,6 +188,14 @@ class LyticsAPIToGoogleCloudStorage(BaseOperator):
             gcs_bucket=None,
             gcs_filepath=None,
             properties=None,
+            staging='stream', # "stream" uploads while writing, "local" stages the output in a temporary file
+            compression=None, # None or "gzip", compresses the output on the fly
+            compression_level=6, # 1 (fastest) to 9 (smallest)
+            max_concurrency=1, # number of job logs / ML summaries fetched in parallel
+            max_failed_ids=None, # failed job logs / ML summaries tolerated (default no limit unless all fail)
+            watermark_filepath=None, # object in gcs_bucket with the per job watermarks of incremental job logs
+            watermark_field=None, # ordered log entry field of the watermark (ISO 8601 timestamp or number)
+            watermark_id_field='id', # log entry field telling entries with the same watermark_field apart
             *args, **kwargs):
         super(LyticsAPIToGoogleCloudStorage, self).__init__(*args, **kwargs)
         self.lytics_conn_id = lytics_conn_id
@@ -39,8 +204,22 @@ class LyticsAPIToGoogleCloudStorage(BaseOperator):
         self.gcs_bucket = gcs_bucket
         self.gcs_filepath = gcs_filepath
         self.properties = properties
+        self.staging = staging
+        self.compression = compression
+        self.compression_level = compression_level
+        self.max_concurrency = max_concurrency
+        self.max_failed_ids = max_failed_ids
+        self.watermark_filepath = watermark_filepath
+        self.watermark_field = watermark_field
+        self.watermark_id_field = watermark_id_field
+        self._staged_watermarks = None
 
+    @report_request_metrics
     def execute(self, context):
+        handler = LYTICS_API_PATHS.get(self.lytics_api_path)
+        if handler is None:
+            raise AirflowFailException(f"Unsupported API path {self.lytics_api_path}")
+
         # initialize hooks to Lytics and GCS
         lytics_api_hook = LyticsAPIHook(
             lytics_conn_id=self.lytics_conn_id
@@ -49,83 +228,80 @@ class LyticsAPIToGoogleCloudStorage(BaseOperator):
             gcp_conn_id=self.gcp_conn_id
         )
 
-        with NamedTemporaryFile("w") as f:
-            records = []
-            if self.lytics_api_path == "/v2/job":
-                get_v2_job_r= lytics_api_hook.get_v2_job(show_deleted=True, show_completed=True, check_http_error=True)
-                get_v2_job = json.loads(get_v2_job_r.text)
-
-                for data in get_v2_job["data"]:
-                    records.append({
-                        "timestamp": str(datetime.utcnow()),
-                        "data": data
-                    })
-            elif self.lytics_api_path == "/v2/job/{id}/logs":
-                get_v2_job_r= lytics_api_hook.get_v2_job(show_deleted=False, show_completed=False, check_http_error=True)
-                get_v2_job = json.loads(get_v2_job_r.text)
-
-                for get_v2_job_data in get_v2_job["data"]:
-                    id = get_v2_job_data["id"]
-                    get_v2_job_logs_r= lytics_api_hook.get_v2_job_logs(id, check_http_error=True)
-                    get_v2_job_logs = json.loads(get_v2_job_logs_r.text)
-
-                    for get_v2_job_logs_data in get_v2_job_logs["data"]:
-                        records.append({
-                            "timestamp":str(datetime.utcnow()),
-                            "data": get_v2_job_logs_data
-                        })
-            elif self.lytics_api_path == "/api/ml":
-                get_v1_ml_r= lytics_api_hook.get_v1_ml(check_http_error=True)
-                get_v1_ml = json.loads(get_v1_ml_r.text)
-
-                for data in get_v1_ml["data"]:
-                    records.append({
-                        "timestamp": str(datetime.utcnow()),
-                        "data": data
-                    })
-            elif self.lytics_api_path == "/api/ml/{id}/summary":
-                get_v1_ml_r= lytics_api_hook.get_v1_ml(check_http_error=True)
-                get_v1_ml = json.loads(get_v1_ml_r.text)
-
-                for get_v1_ml_data in get_v1_ml["data"]:
-                    id = get_v1_ml_data["id"]
-                    get_v1_ml_summary_r= lytics_api_hook.get_v1_ml_summary(id, check_http_error=True)
-                    get_v1_ml_summary = json.loads(get_v1_ml_summary_r.text)
-                    
-                    records.append({
-                        "timestamp": str(datetime.utcnow()),
-                        "data": get_v1_ml_summary["data"]
-                    })
-            elif self.lytics_api_path == "/api/segment/sizes":
-                if self.properties is None:
-                    raise AirflowFailException(f"Missing required properties for API path {self.lytics_api_path}")
-
-                response = lytics_api_hook.get_v1_segment_sizes(self.properties["audiences"])
-                results = json.loads(response.text)["data"]
-
-                if results is not None:
-                    for result in results:
-                        records.append({
-                            "timestamp": str(datetime.utcnow()),
-                            "data": result
-                        })
-            elif self.lytics_api_path == "/v2/stream":
-                response = lytics_api_hook.get_v2_stream()
-                results = json.loads(response.text)["data"]
-
-                if results is not None:
-                    for result in results:
-                        records.append({
-                            "timestamp": str(datetime.utcnow()),
-                            "data": result
-                        })
+        if self.watermark_filepath and not self.watermark_field:
+            raise AirflowFailException("watermark_filepath requires watermark_field")
+
+        timestamp = str(datetime.utcnow())
+        records = ({"timestamp": timestamp, "data": data} for data in handler(self, lytics_api_hook, context))
+
+        # stream the data records as newline delimited json
+        with open_gcs_sink(gcs_hook, self.gcs_bucket, self.gcs_filepath, text=False, staging=self.staging,
+                compression=self.compression, compression_level=self.compression_level) as f:
+            for batch in batched(records, WRITE_BATCH_SIZE):
+                f.write(json_codec.dump_lines(batch))
+
+        if self._staged_watermarks is not None:
+            self._save_watermarks(gcs_hook, self._staged_watermarks)
+
+    def load_watermarks(self):
+        """Returns the watermarks saved by the previous run, {} if there are none."""
+
+        gcs_hook = GCSHook(
+            gcp_conn_id=self.gcp_conn_id
+        )
+        if not gcs_hook.exists(self.gcs_bucket, self.watermark_filepath):
+            log.info("No watermarks in gs://%s/%s, exporting all entries", self.gcs_bucket, self.watermark_filepath)
+            return {}
+
+        saved = json_codec.loads(gcs_hook.download(self.gcs_bucket, self.watermark_filepath))
+        if saved.get("watermark_field") != self.watermark_field:
+            log.info("Ignoring watermarks of %s in gs://%s/%s", saved.get("watermark_field"), self.gcs_bucket, self.watermark_filepath)
+            return {}
+        return saved["watermarks"]
+
+    def stage_watermarks(self, watermarks):
+        """Sets the watermarks which are saved once the output was uploaded."""
+
+        self._staged_watermarks = watermarks
+
+    def _save_watermarks(self, gcs_hook, watermarks):
+        gcs_hook.upload(
+            self.gcs_bucket,
+            self.watermark_filepath,
+            data=json_codec.dumps({"watermark_field": self.watermark_field, "watermarks": watermarks}),
+            mime_type="application/json; charset=utf-8"
+        )
+
+    def fetch_each(self, fetch, ids, context):
+        """
+        Calls fetch(lytics_api_hook, id) for every id, max_concurrency ids at
+        a time, and yields the results in id order. Failed ids are skipped,
+        see the class description.
+        """
+
+        lytics_api_hooks = ThreadLocalHook(
+            lambda: LyticsAPIHook(lytics_conn_id=self.lytics_conn_id)
+        )
+
+        def fetch_id(id):
+            try:
+                return id, fetch(lytics_api_hooks.get(), id), None
+            except Exception as e:
+                log.exception("Fetching %s for id %s failed", self.lytics_api_path, id)
+                return id, None, str(e)
+
+        failed_ids = []
+        for id, result, error in ordered_map(fetch_id, ids, self.max_concurrency):
+            if error is not None:
+                failed_ids.append({"id": id, "error": error})
             else:
-                raise AirflowFailException(f"Unsupported API path {self.lytics_api_path}")
-            
-            for record in records:
-                # dump each data record to temp file
-                json.dump(record, f)
-                f.write('\n')
-    
-            f.flush()
-            gcs_hook.upload(self.gcs_bucket, self.gcs_filepath, filename=f.name, mime_type="application/json; charset=utf-8")
+                yield result
+
+        context["ti"].xcom_push(key="failed_ids", value=failed_ids)
+        if not failed_ids:
+            return
+
+        log.warning("Fetching %s failed for %s of %s ids", self.lytics_api_path, len(failed_ids), len(ids))
+        if len(failed_ids) == len(ids) or (self.max_failed_ids is not None and len(failed_ids) > self.max_failed_ids):
+            # raised inside the sink, the previous output is kept
+            raise AirflowException(f"Fetching {self.lytics_api_path} failed for {len(failed_ids)} of {len(ids)} ids")
@@ -0,0 +1,147 @@
+"""
+
+Parquet writer for streamed JSON records
+
+"""
+
+from hooks import json_codec
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+PARQUET_MIME_TYPE = "application/vnd.apache.parquet"
+
+# column collecting (as json) the fields which do not fit the inferred schema
+EXTRA_COLUMN = "_extra"
+
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+_INVALID = object()
+
+
+class ParquetRecordWriter(object):
+    """
+    Writes JSON records (dicts) as parquet row groups to a binary file object.
+
+    The schema is inferred from the first row_group_size records: numeric
+    fields are widened from int64 to float64 when needed, conflicting types
+    fall back to string and nested values (objects, arrays) are stored as
+    json strings. Once the first row group is written the schema is fixed,
+    fields appearing later or values which do not fit their column are kept
+    as json in the EXTRA_COLUMN column, so no data is lost. At most
+    row_group_size records are buffered.
+    """
+
+    def __init__(self, fileobj, row_group_size=100000, compression="snappy"):
+        if pa is None:
+            raise ImportError("Parquet output requires the pyarrow package")
+
+        self.fileobj = fileobj
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+        self._types = None
+        self._schema = None
+        self._writer = None
+        self._buffer = []
+
+    def write(self, record):
+        if self._types is None:
+            self._buffer.append(record)
+            if len(self._buffer) >= self.row_group_size:
+                self._infer_schema()
+                self._flush()
+            return
+
+        self._buffer.append(self._to_row(record))
+        if len(self._buffer) >= self.row_group_size:
+            self._flush()
+
+    def close(self):
+        if self._types is None:
+            self._infer_schema()
+        self._flush()
+        self._writer.close()
+
+    def _infer_schema(self):
+        types = {}
+        for record in self._buffer:
+            for key, value in record.items():
+                types[key] = _merge_types(types.get(key), _value_type(value))
+        types.pop(EXTRA_COLUMN, None)
+
+        # columns with only null values are stored as strings
+        self._types = {key: value_type or pa.string() for key, value_type in types.items()}
+        self._schema = pa.schema(
+            [pa.field(key, value_type) for key, value_type in self._types.items()] +
+            [pa.field(EXTRA_COLUMN, pa.string())]
+        )
+        self._writer = pq.ParquetWriter(self.fileobj, self._schema, compression=self.compression)
+        self._buffer = [self._to_row(record) for record in self._buffer]
+
+    def _to_row(self, record):
+        row = {}
+        extra = {}
+        for key, value in record.items():
+            value_type = self._types.get(key)
+            converted = _INVALID if value_type is None else _cast(value, value_type)
+            if converted is _INVALID:
+                extra[key] = value
+            else:
+                row[key] = converted
+
+        row[EXTRA_COLUMN] = json_codec.dumps_str(extra) if extra else None
+        return row
+
+    def _flush(self):
+        if self._buffer:
+            self._writer.write_table(pa.Table.from_pylist(self._buffer, schema=self._schema))
+            self._buffer = []
+
+
+def _value_type(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return pa.bool_()
+    if isinstance(value, int):
+        return pa.int64() if _INT64_MIN <= value <= _INT64_MAX else pa.string()
+    if isinstance(value, float):
+        return pa.float64()
+    return pa.string()
+
+
+def _merge_types(a, b):
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if {a, b} == {pa.int64(), pa.float64()}:
+        return pa.float64()
+    return pa.string()
+
+
+def _cast(value, value_type):
+    if value is None:
+        return None
+
+    if value_type == pa.string():
+        return value if isinstance(value, str) else json_codec.dumps_str(value)
+
+    if isinstance(value, bool):
+        return value if value_type == pa.bool_() else _INVALID
+
+    if value_type == pa.int64():
+        if isinstance(value, int) and _INT64_MIN <= value <= _INT64_MAX:
+            return value
+        if isinstance(value, float) and value.is_integer() and _INT64_MIN <= int(value) <= _INT64_MAX:
+            return int(value)
+        return _INVALID
+
+    if value_type == pa.float64() and isinstance(value, (int, float)):
+        return float(value)
+
+    return _INVALID
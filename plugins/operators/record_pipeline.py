@@ -0,0 +1,51 @@
+"""
+
+Record transformations of the export operators
+
+The functions here run in worker processes as well, keep this module free of
+heavy imports.
+
+"""
+
+import hashlib
+from itertools import islice
+
+from hooks import json_codec
+
+
+def add_hashed_user_id(record):
+    """Adds the sha256 hash of the lowercased email as userId."""
+
+    record['userId'] = hashlib.sha256(record['email'].encode('utf-8').strip().lower()).hexdigest().lower()
+    return record
+
+
+def transform_lines(transform_record, lines, serialize=True):
+    """
+    Parses and transforms a batch of newline delimited json lines.
+
+    :param transform_record: picklable function applied to every record
+    :type transform_record: callable
+    :param lines: json lines (bytes or str), empty lines are skipped
+    :type lines: list
+    :param serialize: return the records as newline delimited json bytes
+        instead of a list of records
+    :type serialize: bool
+    """
+
+    records = [transform_record(json_codec.loads(line)) for line in lines if line]
+    if not serialize:
+        return records
+
+    return json_codec.dump_lines(records)
+
+
+def batched(iterable, size):
+    """Yields lists of up to size items."""
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,323 @@
+"""
+### Description
+
+Iterable export trigger
+
+Streams Iterable data exports (export/data.json) to GCS within the Airflow
+triggerer, so deferred export operators do not hold a worker slot while
+they wait on the network. The response is downloaded with aiohttp and
+uploaded with a GCS resumable upload as it arrives, memory is bounded by
+the upload chunk size.
+
+"""
+import asyncio
+import importlib
+import logging
+import random
+import zlib
+from functools import partial
+from urllib.parse import quote
+
+import aiohttp
+from airflow.hooks.base import BaseHook
+from airflow.providers.google.cloud.hooks.gcs import GCSAsyncHook
+from airflow.triggers.base import BaseTrigger, TriggerEvent
+from asgiref.sync import sync_to_async
+
+from hooks.rate_limiter import retry_after_seconds
+from operators.gcs_sink import COMPRESSIONS, DEFAULT_CHUNK_SIZE, JSON_MIME_TYPE
+from operators.record_pipeline import transform_lines
+
+log = logging.getLogger(__name__)
+
+GCS_UPLOAD_URL = "https://storage.googleapis.com/upload/storage/v1/b/{bucket}/o?uploadType=resumable"
+
+# statuses of the export request which are retried
+RETRIED_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _import_function(path):
+    # "module:qualified.name", e.g. "operators.record_pipeline:add_hashed_user_id"
+    module_name, _, qualname = path.partition(":")
+    function = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        function = getattr(function, name)
+    return function
+
+
+def _backoff_seconds(attempt, retry_after=None):
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(60, 2 ** attempt))
+
+
+class _ResumableUpload(object):
+    """
+    GCS resumable upload fed with bytes as they are produced.
+
+    Full chunks are sent as soon as they are buffered, the object is only
+    created by finish(), cancel() discards the upload session.
+    """
+
+    def __init__(self, session, token, bucket_name, object_name, mime_type=JSON_MIME_TYPE,
+            content_encoding=None, chunk_size=DEFAULT_CHUNK_SIZE, retries=5):
+        self.session = session
+        self.token = token
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.mime_type = mime_type
+        self.content_encoding = content_encoding
+        self.chunk_size = chunk_size
+        self.retries = retries
+
+        self.upload_url = None
+        self.offset = 0 # bytes persisted by GCS
+        self.buffer = bytearray()
+
+    async def start(self):
+        metadata = {"name": self.object_name, "contentType": self.mime_type}
+        if self.content_encoding:
+            metadata["contentEncoding"] = self.content_encoding
+
+        response = await self._request("POST", GCS_UPLOAD_URL.format(bucket=quote(self.bucket_name, safe="")),
+            json=metadata, headers={"X-Upload-Content-Type": self.mime_type})
+        self.upload_url = response.headers["Location"]
+
+    async def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            await self._put(final=False)
+
+    async def finish(self):
+        """Uploads the remaining bytes and finalizes the object, returns its size."""
+
+        await self._put(final=True)
+        return self.offset
+
+    async def cancel(self):
+        if self.upload_url is None:
+            return
+        try:
+            async with self.session.delete(self.upload_url, headers=await self._auth_headers()):
+                pass
+        except aiohttp.ClientError:
+            # unfinished sessions expire after a week, no object is created
+            log.warning("Could not cancel the upload of gs://%s/%s", self.bucket_name, self.object_name)
+
+    async def _put(self, final):
+        while True:
+            size = len(self.buffer) if final else self.chunk_size - self.chunk_size % (256 * 1024)
+            chunk = bytes(self.buffer[:size])
+            total = str(self.offset + len(chunk)) if final else "*"
+            content_range = f"bytes {self.offset}-{self.offset + len(chunk) - 1}/{total}" if chunk else f"bytes */{total}"
+
+            response = await self._request("PUT", self.upload_url, data=chunk,
+                headers={"Content-Range": content_range}, expected=(200, 201, 308))
+
+            if response.status in (200, 201):
+                self.offset += len(chunk)
+                self.buffer = bytearray()
+                return
+
+            # 308: GCS reports the bytes it persisted, which may be less than sent
+            persisted = int(response.headers["Range"].rpartition("-")[2]) + 1 if "Range" in response.headers else 0
+            del self.buffer[:persisted - self.offset]
+            self.offset = persisted
+            if not final:
+                return
+
+    async def _request(self, method, url, expected=(200, 201), headers=None, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.request(method, url, headers=dict(headers or {}, **await self._auth_headers()),
+                        **kwargs) as response:
+                    await response.read()
+                    if response.status in expected:
+                        return response
+                    if response.status not in RETRIED_STATUSES or attempt == self.retries:
+                        response.raise_for_status()
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                            status=response.status, message="Unexpected status")
+                    wait = _backoff_seconds(attempt, retry_after_seconds(response.headers.get("Retry-After")))
+            except aiohttp.ClientConnectionError:
+                if attempt == self.retries:
+                    raise
+                wait = _backoff_seconds(attempt)
+            await asyncio.sleep(wait)
+
+    async def _auth_headers(self):
+        # the token is refreshed when it expires during long uploads
+        return {"Authorization": f"Bearer {await self.token.get()}"}
+
+
+class IterableExportTrigger(BaseTrigger):
+    """
+    Exports one or more windows of an Iterable data export to GCS.
+
+    :param windows: [start_date_time, end_date_time, object_name] per
+        output object, up to parallel_windows are exported at the same time
+    :type windows: list
+    :param transform: "module:qualified.name" of a function applied to every
+        record (see IterableExportAPIToGoogleCloudStorage.transform_record),
+        None copies the response bytes as they are
+    :type transform: string
+    """
+
+    def __init__(self, itr_conn_id, gcp_conn_id, data_type_name, only_fields, gcs_bucket, windows,
+            parallel_windows=1, transform=None, transform_batch_size=10000, buffer_size=102400,
+            chunk_size=DEFAULT_CHUNK_SIZE, compression=None, compression_level=6, read_timeout=3600, retries=5):
+        super(IterableExportTrigger, self).__init__()
+        self.itr_conn_id = itr_conn_id
+        self.gcp_conn_id = gcp_conn_id
+        self.data_type_name = data_type_name
+        self.only_fields = only_fields
+        self.gcs_bucket = gcs_bucket
+        self.windows = windows
+        self.parallel_windows = parallel_windows
+        self.transform = transform
+        self.transform_batch_size = transform_batch_size
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.read_timeout = read_timeout
+        self.retries = retries
+
+    def serialize(self):
+        return (
+            "triggers.iterable_export_trigger.IterableExportTrigger",
+            {
+                "itr_conn_id": self.itr_conn_id,
+                "gcp_conn_id": self.gcp_conn_id,
+                "data_type_name": self.data_type_name,
+                "only_fields": self.only_fields,
+                "gcs_bucket": self.gcs_bucket,
+                "windows": self.windows,
+                "parallel_windows": self.parallel_windows,
+                "transform": self.transform,
+                "transform_batch_size": self.transform_batch_size,
+                "buffer_size": self.buffer_size,
+                "chunk_size": self.chunk_size,
+                "compression": self.compression,
+                "compression_level": self.compression_level,
+                "read_timeout": self.read_timeout,
+                "retries": self.retries,
+            },
+        )
+
+    async def run(self):
+        try:
+            itr_conn = await sync_to_async(BaseHook.get_connection)(self.itr_conn_id)
+            transform_record = _import_function(self.transform) if self.transform else None
+
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=self.read_timeout)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                storage = await GCSAsyncHook(gcp_conn_id=self.gcp_conn_id).get_storage_client(session)
+                semaphore = asyncio.Semaphore(max(self.parallel_windows, 1))
+
+                async def export_window(window):
+                    async with semaphore:
+                        return await self._export_window(session, storage.token, itr_conn, transform_record, *window)
+
+                tasks = [asyncio.ensure_future(export_window(window)) for window in self.windows]
+                try:
+                    results = await asyncio.gather(*tasks)
+                finally:
+                    # stop the other windows after a failure and let them cancel their uploads
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+        except Exception as e:
+            log.exception("Iterable export failed")
+            yield TriggerEvent({"status": "error", "message": f"{type(e).__name__}: {e}"})
+            return
+
+        yield TriggerEvent({
+            "status": "success",
+            "objects": [result["object_name"] for result in results],
+            "bytes": sum(result["bytes"] for result in results),
+            "records": sum(result["records"] for result in results) if transform_record else None,
+        })
+
+    async def _export_window(self, session, token, itr_conn, transform_record, start_date_time, end_date_time, object_name):
+        log.info("Exporting %s from %s to %s into gs://%s/%s", self.data_type_name, start_date_time, end_date_time, self.gcs_bucket, object_name)
+
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 31) if self.compression == "gzip" else None
+        upload = _ResumableUpload(session, token, self.gcs_bucket, object_name, chunk_size=self.chunk_size,
+            content_encoding=COMPRESSIONS[self.compression][0] if self.compression else None, retries=self.retries)
+        loop = asyncio.get_running_loop()
+        records = 0
+
+        # CPU bound work runs off the event loop, so the triggerer keeps serving other triggers
+        async def write(data):
+            if compressor:
+                data = await loop.run_in_executor(None, compressor.compress, data)
+            await upload.write(data)
+
+        try:
+            await upload.start()
+            async with await self._request_export(session, itr_conn, start_date_time, end_date_time) as response:
+                if transform_record is None:
+                    async for chunk in response.content.iter_chunked(self.buffer_size):
+                        await write(chunk)
+                else:
+                    transform_batch = partial(transform_lines, transform_record)
+                    async for lines in self._iter_line_batches(response):
+                        await write(await loop.run_in_executor(None, transform_batch, lines))
+                        records += len(lines)
+
+            if compressor:
+                await upload.write(compressor.flush())
+            size = await upload.finish()
+        except BaseException:
+            # also on cancellation (triggerer shutdown), the trigger is run again from the start
+            await asyncio.shield(upload.cancel())
+            raise
+
+        return {"object_name": object_name, "bytes": size, "records": records}
+
+    async def _request_export(self, session, itr_conn, start_date_time, end_date_time):
+        params = [("range", "All"), ("dataTypeName", self.data_type_name)]
+        if start_date_time:
+            params.append(("startDateTime", start_date_time))
+        if end_date_time:
+            params.append(("endDateTime", end_date_time))
+        only_fields = [self.only_fields] if isinstance(self.only_fields, str) else self.only_fields or []
+        params.extend(("onlyFields", field) for field in only_fields)
+
+        for attempt in range(self.retries + 1):
+            try:
+                response = await session.get(f"{itr_conn.host}/api/export/data.json", params=params,
+                    headers={"Api-Key": itr_conn.password})
+            except aiohttp.ClientConnectionError:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(_backoff_seconds(attempt))
+                continue
+
+            if response.status < 400:
+                return response
+
+            retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+            response.release()
+            if response.status not in RETRIED_STATUSES or attempt == self.retries:
+                response.raise_for_status()
+            log.warning("Export request failed with %s, retrying", response.status)
+            await asyncio.sleep(_backoff_seconds(attempt, retry_after))
+
+    async def _iter_line_batches(self, response):
+        # StreamReader.readline limits the line length, split the chunks instead
+        lines = []
+        rest = b""
+        async for chunk in response.content.iter_chunked(self.buffer_size):
+            chunk_lines = (rest + chunk).split(b"\n")
+            rest = chunk_lines.pop()
+            lines.extend(line for line in chunk_lines if line.strip())
+            if len(lines) >= self.transform_batch_size:
+                yield lines
+                lines = []
+
+        if rest.strip():
+            lines.append(rest)
+        if lines:
+            yield lines